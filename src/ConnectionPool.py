@@ -0,0 +1,155 @@
+#********************************************************************
+# Author: Lauro França (oPisiti)                                    #
+# Contact:                                                          #
+#   github: oPisiti                                                 #
+#   Email: contact@opisiti.com                                      #
+# Date: May, 2023                                                   #
+# Description:                                                      #
+#   Connections to a sqlite3 database: a file in write ahead log    #
+#   mode, with a serialized writer and a reader per thread, a       #
+#   single connection which only reads, or a database held in       #
+#   memory only                                                     #
+#********************************************************************
+
+import sqlite3
+import threading
+
+
+# Seconds a connection waits for another one's lock before raising "database is locked"
+BUSY_TIMEOUT = 30.0
+
+# Page cache of every connection, in KiB
+CACHE_SIZE_KIB = 16 * 1024
+
+# sqlite3's name for a database held in memory only. See MemoryConnectionPool
+MEMORY_DB_PATH = ":memory:"
+
+
+class ConnectionPool():
+    # Whether the database is lost once closed, and can not be opened by other connections or processes
+    in_memory = False
+
+    def __init__(self, db_path: str, busy_timeout: float = BUSY_TIMEOUT, cache_size_kib: int = CACHE_SIZE_KIB) -> None:
+        """
+        Connections to the database at db_path, which is switched to write ahead logging (WAL):
+        readers neither wait for the writer nor block it, whichever process they are in.
+            - writer:   the only connection which writes. Shared by every thread, one at a time, holding write_lock;
+            - reader(): the calling thread's own connection, which only reads.
+        Every connection returns rows as sqlite3.Row
+        """
+
+        self.db_path        = db_path
+        self.busy_timeout   = busy_timeout
+        self.cache_size_kib = cache_size_kib
+
+        self.write_lock = threading.RLock()
+        self.writer     = self._connect()
+
+        # Stored in the file: every connection to it, from now on, uses the write ahead log
+        self.writer.execute("PRAGMA journal_mode = WAL")
+
+        self._local        = threading.local()
+        self._readers      = []
+        self._readers_lock = threading.Lock()
+
+
+    def _connect(self) -> sqlite3.Connection:
+        """ Opens a connection to the database, tuned for the write ahead log """
+
+        # Used by whichever thread holds it: the writer under write_lock, readers by their own thread only
+        conn = sqlite3.connect(self.db_path, timeout = self.busy_timeout, check_same_thread = False)
+        conn.row_factory = sqlite3.Row
+
+        # In WAL mode, syncing at checkpoints rather than at every commit can not corrupt the database:
+        # at worst, the latest commits are lost on a power failure
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = {-self.cache_size_kib}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+        return conn
+
+
+    def close(self) -> None:
+        """ Closes every connection. Uncommitted writes are rolled back """
+
+        with self._readers_lock:
+            for conn in self._readers: conn.close()
+            self._readers.clear()
+
+        self.writer.close()
+
+
+    def reader(self) -> sqlite3.Connection:
+        """ Returns the calling thread's read only connection, opened on first use """
+
+        conn = getattr(self._local, "reader", None)
+        if conn is not None: return conn
+
+        conn = self._connect()
+        conn.execute("PRAGMA query_only = ON")
+
+        self._local.reader = conn
+        with self._readers_lock: self._readers.append(conn)
+
+        return conn
+
+
+class MemoryConnectionPool(ConnectionPool):
+    # See ConnectionPool
+    in_memory = True
+
+    def __init__(self, cache_size_kib: int = CACHE_SIZE_KIB) -> None:
+        """
+        A database held in memory only, e.g., for tests and benchmarks: nothing is read from or written to disk.
+        It starts empty and is lost once closed.
+        A single connection, which is both the writer and every thread's reader:
+        reads from other threads see writes not yet committed
+        """
+
+        self.db_path        = MEMORY_DB_PATH
+        self.busy_timeout   = BUSY_TIMEOUT
+        self.cache_size_kib = cache_size_kib
+
+        self.write_lock = threading.RLock()
+        self.writer     = self._connect()
+
+
+    def close(self) -> None:
+        """ Closes the connection, along with the database """
+
+        self.writer.close()
+
+
+    def reader(self) -> sqlite3.Connection:
+        """ Returns the only connection. See __init__() """
+
+        return self.writer
+
+
+class ReadOnlyConnectionPool(ConnectionPool):
+    def __init__(self, db_path: str, busy_timeout: float = BUSY_TIMEOUT, cache_size_kib: int = CACHE_SIZE_KIB) -> None:
+        """
+        A single connection to the database at db_path, which only reads, e.g., from worker processes checking the chain.
+        Unlike ConnectionPool, opening it writes nothing to the file, not even its journal mode, so it takes no lock.
+        It is both the writer and every thread's reader: writes raise sqlite3.OperationalError
+        """
+
+        self.db_path        = db_path
+        self.busy_timeout   = busy_timeout
+        self.cache_size_kib = cache_size_kib
+
+        self.write_lock = threading.RLock()
+        self.writer     = self._connect()
+        self.writer.execute("PRAGMA query_only = ON")
+
+
+    def close(self) -> None:
+        """ Closes the connection """
+
+        self.writer.close()
+
+
+    def reader(self) -> sqlite3.Connection:
+        """ Returns the only connection. See __init__() """
+
+        return self.writer
@@ -0,0 +1,147 @@
+#********************************************************************
+# Author: Lauro França (oPisiti)                                    #
+# Contact:                                                          #
+#   github: oPisiti                                                 #
+#   Email: contact@opisiti.com                                      #
+# Date: May, 2023                                                   #
+# Description:                                                      #
+#   A registry of SHA256 implementations, checked against known     #
+#   vectors before being used                                       #
+#********************************************************************
+
+import hashlib
+import os
+
+from SHA256 import SHA256Hash, to_bytes
+from SHA256Batch import NUMPY_AVAILABLE, bytes_to_suffixes, digest_to_hex, mine_nonces, sha256_batch
+
+# Environment variable which overrides the default backend
+BACKEND_ENV_VAR = "HASH_BACKEND"
+
+# Preference order when no backend is chosen: fastest first.
+# The batch backend is only used when explicitly chosen, since it only speeds up mining
+DEFAULT_PRIORITY = ("hashlib", "reference")
+
+# FIPS 180-2 test vectors: (message, hex digest)
+KNOWN_VECTORS = (
+    (b"", "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"),
+    (b"abc", "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"),
+    (b"abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq", "248d6a61d20638b8e5c026930c3e6039a33ce45964ff2167f6ecedd419db06c1"),
+    (b"abcdefghbcdefghicdefghijdefghijkefghijklfghijklmghijklmnhijklmnoijklmnopjklmnopqklmnopqrlmnopqrsmnopqrstnopqrstu", "cf5b16a778af8380036ce59e7b0492370b249b11e8f07a51afac45037afee9d1"),
+)
+
+
+class HashBackend():
+    def __init__(self, name: str, new, mine_nonces = None, available: bool = True) -> None:
+        """
+        A named SHA256 implementation
+        new:         callable(message = b"") returning a hashlib like object (update, copy, digest, hexdigest)
+        mine_nonces: optional lane parallel search. See SHA256Batch.mine_nonces()
+        available:   False if the backend's dependencies are not installed
+        """
+
+        self.name        = name
+        self.new         = new
+        self.mine_nonces = mine_nonces
+        self.available   = available
+
+        self._self_test_passed = None
+
+
+    def __repr__(self) -> str:
+        return f"HashBackend('{self.name}')"
+
+
+    def hexdigest(self, message) -> str:
+        """ Returns the hex digest of a message (str or bytes) """
+
+        return self.new(message).hexdigest()
+
+
+    def self_test(self) -> bool:
+        """
+        Cross checks the backend against known vectors, once. Later calls return the cached result.
+        Covers one shot, incremental (update and copy) and, if any, batch hashing
+        """
+
+        if self._self_test_passed is not None: return self._self_test_passed
+
+        passed = self.available
+        for message, expected in KNOWN_VECTORS:
+            if not passed: break
+
+            passed = self.new(message).hexdigest() == expected
+
+            # The same message, fed in two pieces from a cloned state
+            hasher = self.new(message[:len(message) // 2]).copy()
+            hasher.update(message[len(message) // 2:])
+            passed = passed and hasher.hexdigest() == expected
+
+        # The batch path hashes the last 8 bytes of a vector as a per lane suffix
+        if passed and self.mine_nonces is not None:
+            message, expected = KNOWN_VECTORS[2]
+            digests = sha256_batch(message[:-8], bytes_to_suffixes([message[-8:]]))
+            passed = digest_to_hex(digests[0]) == expected
+
+        self._self_test_passed = passed
+
+        return passed
+
+
+def hashlib_new(message = b""):
+    """ hashlib.sha256, also accepting strings (utf-8 encoded) """
+
+    return hashlib.sha256(to_bytes(message))
+
+
+BACKENDS = {}
+
+
+def register_backend(backend: HashBackend) -> None:
+    """ Adds a backend to the registry. Replaces any other with the same name """
+
+    BACKENDS[backend.name] = backend
+
+
+def get_backend(name: str = None) -> HashBackend:
+    """
+    Returns a self tested backend.
+    The name is taken, in order, from the argument, the HASH_BACKEND environment variable or,
+    if neither is set, the fastest backend which passes its self test.
+    Raises LookupError if the chosen backend does not exist
+    Raises RuntimeError if the chosen backend fails its self test
+    """
+
+    if name is None: name = os.environ.get(BACKEND_ENV_VAR)
+
+    # Automatic choice. The reference implementation is the last resort
+    if name is None:
+        for candidate in DEFAULT_PRIORITY:
+            if BACKENDS[candidate].self_test(): return BACKENDS[candidate]
+
+        raise RuntimeError("No SHA256 backend passed its self test")
+
+    try:
+        backend = BACKENDS[name]
+    except KeyError as e:
+        raise LookupError(f"No hash backend named '{name}'. Available: {tuple(BACKENDS.keys())}")
+
+    if not backend.self_test():
+        raise RuntimeError(f"Hash backend '{name}' failed its self test or is not available")
+
+    return backend
+
+
+# The from scratch implementation. Slow, but kept for teaching and audits
+register_backend(HashBackend("reference", SHA256Hash))
+
+# OpenSSL, through the standard library
+register_backend(HashBackend("hashlib", hashlib_new))
+
+# Lane parallel mining with numpy. Single messages are hashed by hashlib
+register_backend(HashBackend("numpy", hashlib_new, mine_nonces = mine_nonces, available = NUMPY_AVAILABLE))
+
+
+if __name__ == "__main__":
+    for backend in BACKENDS.values():
+        print(f"{backend.name}: {'OK' if backend.self_test() else 'FAILED'}")
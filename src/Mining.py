@@ -0,0 +1,275 @@
+#********************************************************************
+# Author: Lauro França (oPisiti)                                    #
+# Contact:                                                          #
+#   github: oPisiti                                                 #
+#   Email: contact@opisiti.com                                      #
+# Date: May, 2023                                                   #
+# Description:                                                      #
+#   Nonce search for block mining, in one or many processes         #
+#********************************************************************
+
+import itertools
+import multiprocessing
+import struct
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from HashBackends import HashBackend, get_backend
+from SHA256 import SHA256Hash
+from SHA256Batch import BATCH_SIZE, digest_to_hex, nonce_range
+
+# Header layout 2 appends the nonce as a fixed width, big endian, unsigned 64 bits integer
+HEADER_NONCE_FORMAT = ">Q"
+
+# Amount of nonces between two checks for cancellation and progress, in the scalar search
+CHECK_INTERVAL = 1024
+
+# Seconds between two progress reports
+REPORT_INTERVAL = 0.5
+
+# Amount of consecutive nonces handed to a worker process at a time
+NONCE_CHUNK_SIZE = 2**16
+
+# Shared with the worker processes. See _init_worker()
+_cancel_event  = None
+_nonces_tried = None
+
+
+class MiningStats():
+    def __init__(self, target: int, report_interval: float = REPORT_INTERVAL) -> None:
+        """
+        Mining telemetry: nonces tried, elapsed time, hashrate and estimated time to solution.
+        Sampled on a timer, every report_interval seconds, rather than per nonce
+        """
+
+        self.target          = target
+        self.report_interval = report_interval
+        self.nonces_tried    = 0
+        self.elapsed         = 0.0
+
+        self._start_time  = time.perf_counter()
+        self._last_report = self._start_time
+
+
+    def __repr__(self) -> str:
+        return f"{self.nonces_tried} nonces | {self.hashrate:.0f} H/s | {self.elapsed:.1f} s elapsed | ~{self.eta:.1f} s to solution"
+
+
+    @property
+    def expected_hashes(self) -> float:
+        """ Average amount of hashes needed to meet the target """
+
+        return 2**256 / (self.target + 1)
+
+
+    @property
+    def eta(self) -> float:
+        """
+        Estimated seconds to a solution, at the current hashrate.
+        Every nonce is an independent try, so the estimate does not shrink with the nonces already tried
+        """
+
+        if self.hashrate == 0: return float("inf")
+
+        return self.expected_hashes / self.hashrate
+
+
+    @property
+    def hashrate(self) -> float:
+        """ Hashes per second """
+
+        return self.nonces_tried / self.elapsed if self.elapsed > 0 else 0.0
+
+
+    def record(self, nonces_tried: int) -> bool:
+        """
+        Updates the amount of nonces tried and the elapsed time.
+        Returns True if a report is due, i.e., report_interval seconds have passed since the last one
+        """
+
+        now = time.perf_counter()
+        self.nonces_tried = nonces_tried
+        self.elapsed      = now - self._start_time
+
+        if now - self._last_report < self.report_interval: return False
+
+        self._last_report = now
+        return True
+
+
+def search_nonces(version: int, message, target: int, hash_backend: HashBackend, start: int = 0, stop: int = None, on_check = None, cancel_event = None) -> tuple:
+    """
+    Searches the nonces in [start, stop) for a hash which, read as a 256 bits integer, is <= target.
+    If stop is None, searches until one is found.
+    version: the block's header layout
+    message: layout 1:    the partial string, to which hex(nonce) is prepended.
+             Other layouts: the header prefix, to which the packed nonce is appended
+    on_check:     optional callable(nonces tried so far), called every CHECK_INTERVAL nonces (or every batch of nonces)
+    cancel_event: optional multiprocessing.Event. The search stops soon after it is set
+    Returns (nonce, hash, amount of nonces tried). nonce and hash are None if the range is exhausted or the search cancelled
+    """
+
+    # Backends with a lane parallel search need the nonce to be a fixed width suffix
+    if hash_backend.mine_nonces is not None and version != 1:
+        return _search_nonces_batch(message, target, hash_backend, start, stop, on_check, cancel_event)
+
+    return _search_nonces_scalar(version, message, target, hash_backend, start, stop, on_check, cancel_event)
+
+
+def _search_nonces_batch(message: bytes, target: int, hash_backend: HashBackend, start: int, stop: int, on_check, cancel_event) -> tuple:
+    """ Hashes up to BATCH_SIZE nonces at a time. See search_nonces() """
+
+    # The lanes start from the prefix's midstate, which only the from scratch hasher exposes
+    prefix_hasher = SHA256Hash(message)
+    batch_start = start
+
+    while stop is None or batch_start < stop:
+        if cancel_event is not None and cancel_event.is_set(): break
+        if on_check is not None: on_check(batch_start - start)
+
+        size = BATCH_SIZE if stop is None else min(BATCH_SIZE, stop - batch_start)
+        lanes, digests = hash_backend.mine_nonces(prefix_hasher, nonce_range(batch_start, size), target)
+
+        if len(lanes):
+            return batch_start + int(lanes[0]), digest_to_hex(digests[lanes[0]]), batch_start - start + int(lanes[0]) + 1
+
+        batch_start += size
+
+    return None, None, batch_start - start
+
+
+def _search_nonces_scalar(version: int, message, target: int, hash_backend: HashBackend, start: int, stop: int, on_check, cancel_event) -> tuple:
+    """ Tries one nonce at a time. See search_nonces() """
+
+    # Layouts other than 1 hash the constant prefix only once
+    if version != 1: prefix_hasher = hash_backend.new(message)
+
+    # Fixed width, lower case hex strings compare just like the integers they represent
+    target_hex = format(target, "064x")
+    nonce = start
+
+    while stop is None or nonce < stop:
+        # Checking rarely, so that the hot loop only hashes
+        if (nonce - start) % CHECK_INTERVAL == 0:
+            if cancel_event is not None and cancel_event.is_set(): break
+            if on_check is not None: on_check(nonce - start)
+
+        if version == 1:
+            this_hash = hash_backend.hexdigest(hex(nonce) + message)
+        else:
+            hasher = prefix_hasher.copy()
+            hasher.update(struct.pack(HEADER_NONCE_FORMAT, nonce))
+            this_hash = hasher.hexdigest()
+
+        if this_hash <= target_hex: return nonce, this_hash, nonce - start + 1
+
+        nonce += 1
+
+    return None, None, nonce - start
+
+
+def _init_worker(cancel_event, nonces_tried) -> None:
+    """ Shares the cancellation event and the nonces counter with a worker process """
+
+    global _cancel_event, _nonces_tried
+    _cancel_event = cancel_event
+    _nonces_tried = nonces_tried
+
+
+def _count_nonces(amount: int) -> None:
+    """ Adds to the nonces counter shared by every worker process """
+
+    with _nonces_tried.get_lock():
+        _nonces_tried.value += amount
+
+
+def _mine_worker(version: int, message, target: int, backend_name: str, worker_index: int, workers: int, chunk_size: int) -> tuple:
+    """
+    Searches the chunks of nonces worker_index, worker_index + workers, worker_index + 2 * workers...
+    until a valid nonce is found or the search is cancelled.
+    Returns (nonce, hash). Both are None if cancelled
+    """
+
+    hash_backend = get_backend(backend_name)
+
+    for start in itertools.count(worker_index * chunk_size, workers * chunk_size):
+        counted = 0
+
+        def on_check(tried: int) -> None:
+            nonlocal counted
+            _count_nonces(tried - counted)
+            counted = tried
+
+        nonce, this_hash, tried = search_nonces(version, message, target, hash_backend, start, start + chunk_size, on_check = on_check, cancel_event = _cancel_event)
+        _count_nonces(tried - counted)
+
+        if nonce is not None or _cancel_event.is_set(): return nonce, this_hash
+
+
+def mine_parallel(version: int, message, target: int, backend_name: str, workers: int, chunk_size: int = NONCE_CHUNK_SIZE, stats: MiningStats = None, on_progress = None) -> tuple:
+    """
+    Splits the nonce space into chunks, searched by a pool of worker processes.
+    The first worker to find a valid nonce cancels the others.
+    See search_nonces() for the arguments.
+    stats:       optional MiningStats, updated with the nonces tried by every worker
+    on_progress: optional callable(stats), called every stats.report_interval seconds
+    Returns (nonce, hash, amount of nonces tried by every worker)
+    """
+
+    if stats is None: stats = MiningStats(target)
+
+    cancel_event = multiprocessing.Event()
+    nonces_tried = multiprocessing.Value("Q", 0)
+    result = None
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (cancel_event, nonces_tried)) as executor:
+        pending = {
+            executor.submit(_mine_worker, version, message, target, backend_name, i, workers, chunk_size)
+            for i in range(workers)
+        }
+
+        # Whatever happens, no worker may be left searching
+        try:
+            while pending:
+                done, pending = wait(pending, timeout = stats.report_interval, return_when = FIRST_COMPLETED)
+
+                for future in done:
+                    nonce, this_hash = future.result()
+
+                    if nonce is not None and result is None:
+                        result = (nonce, this_hash)
+                        cancel_event.set()
+
+                if stats.record(nonces_tried.value) and on_progress is not None and result is None: on_progress(stats)
+        finally:
+            cancel_event.set()
+
+    stats.record(nonces_tried.value)
+
+    return result[0], result[1], stats.nonces_tried
+
+
+def search_with_stats(version: int, message, target: int, hash_backend: HashBackend, stats: MiningStats = None, on_progress = None) -> tuple:
+    """
+    Searches every nonce from 0 in this process, until one is found.
+    stats:       optional MiningStats, updated as the search goes
+    on_progress: optional callable(stats), called every stats.report_interval seconds
+    Returns (nonce, hash, amount of nonces tried)
+    """
+
+    if stats is None: stats = MiningStats(target)
+
+    def on_check(tried: int) -> None:
+        if stats.record(tried) and on_progress is not None: on_progress(stats)
+
+    nonce, this_hash, tried = search_nonces(version, message, target, hash_backend, on_check = on_check)
+    stats.record(tried)
+
+    return nonce, this_hash, tried
+
+
+def print_progress(stats: MiningStats) -> None:
+    """ Rewrites a single progress line on the terminal """
+
+    # Clearing what is left of a longer, previous line
+    print(f"\r{stats}\033[K", end = "", flush = True)
@@ -0,0 +1,142 @@
+#********************************************************************
+# Author: Lauro França (oPisiti)                                    #
+# Contact:                                                          #
+#   github: oPisiti                                                 #
+#   Email: contact@opisiti.com                                      #
+# Date: May, 2023                                                   #
+# Description:                                                      #
+#   A background thread which mines pending transactions and        #
+#   chains them, in order of submission                             #
+#********************************************************************
+
+import logging
+import sqlite3
+import threading
+
+from ConnectionPool import MEMORY_DB_PATH
+from helper import BlockChain, Block
+
+
+logger = logging.getLogger(__name__)
+
+
+class MiningWorker(threading.Thread):
+    def __init__(self, db_path: str, path_is_relative = True, backend: str = None, workers: int = 1, poll_interval: float = 1.0, max_transactions: int = 100) -> None:
+        """
+        Mines every pending transaction in the database, in order of submission.
+        Up to max_transactions pending transactions are bundled into a single block, mined once.
+        Uses its own connection to the database, opened in the worker's thread.
+        Pending transactions are only removed from the queue in the same commit which chains their block,
+        so whatever is left after a crash is mined on the next start.
+        backend, workers: see Block.mine_block()
+        poll_interval:    seconds between two checks for new pending transactions, unless notify() is called
+        Raises ValueError for a database held in memory (":memory:"): the worker's own connection would open another, empty one
+        """
+
+        if db_path == MEMORY_DB_PATH:
+            raise ValueError("A database held in memory can not be shared with the mining worker. Mine its blocks with Block.mine_block() instead")
+
+        super().__init__(name = "MiningWorker", daemon = True)
+
+        self.db_path          = db_path
+        self.path_is_relative = path_is_relative
+        self.backend          = backend
+        self.workers          = workers
+        self.poll_interval    = poll_interval
+        self.max_transactions = max_transactions
+
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+
+
+    def mine_pending_transactions(self, db: BlockChain, pending_transactions: list) -> None:
+        """
+        Mines and chains a block with a batch of pending transactions, in order, claimed by this worker (see BlockChain.claim_pending_transactions()).
+        The first transaction's miner mines the block.
+        Transactions whose sender can no longer afford them, given the ones before in the block, are rejected.
+        The others are handed back to the queue if their block can not be chained, so that they are mined again
+        """
+
+        balances = {}
+        accepted = []
+        accepted_ids = []
+
+        for pending in pending_transactions:
+            for _id in (pending["from_id"], pending["to_id"]):
+                if _id not in balances: balances[_id] = db.get_account_balance(_id)
+
+            if balances[pending["from_id"]] <= pending["amount"]:
+                db.reject_pending_transaction(pending["id"])
+                continue
+
+            balances[pending["from_id"]] -= pending["amount"]
+            balances[pending["to_id"]]   += pending["amount"]
+
+            accepted.append({
+                "from_id": pending["from_id"],
+                "to_id":   pending["to_id"],
+                "amount":  pending["amount"]
+            })
+            accepted_ids.append(pending["id"])
+
+        if not accepted: return
+
+        miner_id = pending_transactions[0]["miner_id"]
+
+        # Balances are updated along with the block. If another connection chained a block, spent the funds
+        # or settled these transactions meanwhile, nothing is written and the queue is read again on the next iteration
+        try:
+            new_block = Block(db, {"transactions": accepted, "miner_id": miner_id})
+            new_block.mine_block(backend = self.backend, workers = self.workers)
+            new_block.chain_block(db, pending_ids = accepted_ids)
+
+        except ValueError:
+            db.release_pending_transactions(accepted_ids)
+
+        except BaseException:
+            db.release_pending_transactions(accepted_ids)
+            raise
+
+
+    def notify(self) -> None:
+        """ Wakes the worker up, in order to check for new pending transactions right away """
+
+        self._wake_event.set()
+
+
+    def run(self) -> None:
+        db = BlockChain(self.db_path, path_is_relative = self.path_is_relative)
+
+        # Claims left by a worker which stopped while mining. If another one is still mining them, 
+        # only the first block to be chained settles them. See BlockChain.set_block()
+        db.release_pending_transactions()
+
+        while not self._stop_event.is_set():
+            # Another connection may hold the write lock for a long batch. The queue is checked again on the next poll
+            try:
+                pending_transactions = db.claim_pending_transactions(self.max_transactions)
+
+                # Batches in order of submission, until the queue is empty
+                if pending_transactions:
+                    self.mine_pending_transactions(db, pending_transactions)
+                    continue
+
+            except sqlite3.OperationalError:
+                pass
+
+            # Any other error would end the thread, leaving every later transfer pending until the next start
+            except Exception:
+                logger.exception("Mining pending transactions failed. Retrying on the next poll")
+
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+
+
+    def stop(self) -> None:
+        """
+        Asks the worker to stop after the block currently being mined.
+        Transactions still pending are mined on the next start
+        """
+
+        self._stop_event.set()
+        self._wake_event.set()
@@ -16,6 +16,8 @@ import secrets
 
 from getpass import getpass
 from helper import *
+from Mining import print_progress
+from MiningWorker import MiningWorker
 from OptionsMenu import *
 from passlib.hash import pbkdf2_sha256
 from pynput import keyboard as kb
@@ -28,6 +30,7 @@ class Globals:
     CLEAR_COMMAND           = "cls" if os.name == "nt" else "clear"
     LOGGED_IN_ACCOUNT_ID    = None
     LOGGED_IN_USERNAME      = None
+    MINING_WORKER           = None
     PBKDF2_SHA256_SALT_SIZE = 16
     PBKDF2_SHA256_ROUNDS    = 10000
 
@@ -88,7 +91,9 @@ def check_block_chain_health(db: BlockChain) -> None:
 
     os.system(Globals.CLEAR_COMMAND)
 
-    error_on_block_id = db.check_chain_health(amount_blocks)
+    # Checking every block only goes through the blocks not verified yet
+    if amount_blocks < 0: error_on_block_id = db.check_chain_health_from_checkpoint(workers = int(os.environ.get("VERIFY_WORKERS", 1)))
+    else:                 error_on_block_id = db.check_chain_health(amount_blocks, workers = int(os.environ.get("VERIFY_WORKERS", 1)))
 
     if error_on_block_id is None: print("Blockchain is healthy")
     else:                         print(f"Block {Colors.FAIL}#{error_on_block_id}{Colors.ENDC} is broken")
@@ -103,7 +108,7 @@ def choose_a_block_from_chain(db: BlockChain, message: str) -> str:
     """
 
     blocks_ids = list(db.get_blocks_ids())
-    error_on_block_id = db.check_chain_health(-1)
+    error_on_block_id = db.check_chain_health_from_checkpoint(workers = int(os.environ.get("VERIFY_WORKERS", 1)))
     block_state = "\u2714"
 
     # Adding check mark or cross to the start of the ids
@@ -116,49 +121,6 @@ def choose_a_block_from_chain(db: BlockChain, message: str) -> str:
     return int(options_menu(blocks_ids, message)[2:])
 
 
-def create_and_chain_block(db: BlockChain, block_data: dict) -> Block:
-    """ 
-    Creates and chains a new block if possible 
-    block_data must have as keys:
-        - "from_id":  str
-        - "to_id":    str
-        - "amount":   float
-        - "miner_id": str
-
-    Raises ValueError if account from_id does not have enough cash for the transaction
-    """
-
-    # Checking block_data keys
-    required_keys = ("from_id", "to_id", "amount", "miner_id")
-    if tuple(block_data.keys()) != required_keys:
-        raise KeyError(
-                f"""
-                Keys from provided dictionary are incorrect
-                Required keys: {required_keys}
-                """
-                )
-
-    from_balance = db.get_account_balance(block_data["from_id"])
-    amount = block_data["amount"]
-    
-    # Checking if enough cash
-    if from_balance <= amount:
-        raise ValueError(
-            f"""
-            Insufficient funds on account {block_data["from_id"]}.
-            Available cash: {from_balance}.
-            Required cash:  {amount}.
-            """
-        ) 
-
-    # Able to create a block
-    else:
-        new_block = Block(db, block_data)
-
-        new_block.mine_block(print_steps = os.environ["PRINT_STEPS"] == "True")
-        new_block.chain_block(db)
-
-
 def delete_block(db: BlockChain) -> None:
     """
     Prompts for a block and deletes it from the database
@@ -191,7 +153,10 @@ def edit_block(db: BlockChain) -> None:
     block = db.get_block_by_id(chosen_block_id)
     block_lines = get_pretty_block(block)
 
-    edit_line = options_menu(block_lines[1:], block_lines[0])
+    # The previous block is derived from the order of ids, not edited. See BlockChain.update_any_column_any_block()
+    editable_lines = [line for line in block_lines[1:] if not line.startswith("Previous Block:")]
+
+    edit_line = options_menu(editable_lines, block_lines[0])
     chosen_option_index = block_lines.index(edit_line)
 
     # Adding listener for keyboard in order to prefill it and make a line editable
@@ -224,13 +189,17 @@ def edit_block(db: BlockChain) -> None:
     "mined by":          "miner_id",
     "miner reward (p$)": "miner_reward",
     "nonce":             "nonce",
-    "hash":              "hash"   
+    "hash":              "hash",
+    "version":           "version",
+    "target":            "target",
+    "mining time (s)":   "mining_time",
+    "merkle root":       "merkle_root"
     }
 
     column_name = column_match[re.findall("(^.*):", fixed)[0].lower()]
 
     # Making sure float fields are float
-    if column_name in ["amount", "miner_reward"]:
+    if column_name in ["amount", "miner_reward", "mining_time"]:
         try:
             edited = float(edited)
         except ValueError as e:
@@ -239,7 +208,7 @@ def edit_block(db: BlockChain) -> None:
             return
 
     # Making sure int fields are int
-    if column_name in ["nonce"]:
+    if column_name in ["nonce", "version"]:
         try:
             edited = int(edited)
         except ValueError as e:
@@ -280,28 +249,42 @@ def fix_block_chain(db: BlockChain) -> None:
     Detects a chain inconsistency and fixes it
     """
 
-    error_on_block_id = db.check_chain_health(-1)
+    os.system(Globals.CLEAR_COMMAND)
 
-    if error_on_block_id is None: 
-        os.system(Globals.CLEAR_COMMAND)
-        print("Block Chain is healthy")
-        return 
+    # Checked and fixed again whenever blocks are chained meanwhile, e.g., by the mining worker
+    while True:
+        error_on_block_id = db.check_chain_health_from_checkpoint(workers = int(os.environ.get("VERIFY_WORKERS", 1)))
 
-    blocks_ids = db.get_blocks_ids()
-    error_block_index = blocks_ids.index(error_on_block_id)
+        if error_on_block_id is None: 
+            print("Block Chain is healthy")
+            return 
 
-    os.system(Globals.CLEAR_COMMAND)
-    print(f"Fixing blocks...")
-    for i in range(error_block_index, len(blocks_ids)):
+        print(f"Fixing blocks...")
 
-        # Updating previous_hash field 
-        db.update_previous_hash_by_id(blocks_ids[i], blocks_ids)
+        # The broken block and every block after it, in order of id
+        block_ids = []
+        block_id  = error_on_block_id
+        # Ids only increase along the walk, so it cannot revisit a block
+        while block_id is not None and (not block_ids or block_id > block_ids[-1]):
+            block_ids.append(block_id)
+            block_id = db.get_next_block_id(block_id)
 
-        db.remine_block(blocks_ids[i])
+        # Mined one after the other, each linked to the one before. Written at once, at the end.
+        # A throttled progress line is shown while each block is mined, then replaced by its check mark
+        try:
+            db.remine_blocks(
+                block_ids,
+                backend     = os.environ.get("MINING_BACKEND"),
+                workers     = int(os.environ.get("MINING_WORKERS", 1)),
+                on_remined  = lambda _id: print(f"\r{SpecialChars.CHECK_MARK} #{_id}\033[K"),
+                on_progress = print_progress
+            )
+        except ValueError as e:
+            print(f"\r{e}\033[K")
+            continue
 
-        print(f"{SpecialChars.CHECK_MARK} #{blocks_ids[i]}")
-        
-    print("Done!")
+        print("Done!")
+        return
 
 
 def get_all_accounts_pretty(db: BlockChain) -> tuple:
@@ -391,6 +374,12 @@ def get_pretty_block(block: dict) -> tuple:
         - "miner_reward"
         - "nonce"
         - "hash"   
+        - "version"
+        - "target"
+        - "mining_time"
+        - "merkle_root"
+        - "previous_id"
+    Blocks of many transactions (with a merkle root) have None as "from_id", "to_id" and "amount". See get_pretty_transactions()
     """
 
     required_keys = (
@@ -402,7 +391,12 @@ def get_pretty_block(block: dict) -> tuple:
         "miner_id",
         "miner_reward",
         "nonce",
-        "hash"   
+        "hash",
+        "version",
+        "target",
+        "mining_time",
+        "merkle_root",
+        "previous_id"
     )
 
     if required_keys != tuple(block.keys()):
@@ -420,7 +414,21 @@ def get_pretty_block(block: dict) -> tuple:
         f"Mined By:          {block['miner_id']}",
         f"Miner Reward (P$): {block['miner_reward']}",
         f"Nonce:             {block['nonce']}",
-        f"Hash:              {block['hash']}"
+        f"Hash:              {block['hash']}",
+        f"Version:           {block['version']}",
+        f"Target:            {block['target']}",
+        f"Mining Time (s):   {block['mining_time']}",
+        f"Merkle Root:       {block['merkle_root']}",
+        f"Previous Block:    {block['previous_id']}"
+    )
+
+
+def get_pretty_transactions(transactions: list) -> tuple:
+    """ Returns a tuple of strings containing a pretty print of every transaction of a block, in order """
+
+    return tuple(
+        f"    #{position}: {t['from_id']} -> {t['to_id']}: {t['amount']} P$"
+        for position, t in enumerate(transactions)
     )
 
 
@@ -482,26 +490,36 @@ def remine_all_blocks(db: BlockChain) -> None:
     Remines all blocks, independently of their health state
     """
 
-    blocks_ids = db.get_blocks_ids()
-
     os.system(Globals.CLEAR_COMMAND)
-    print(f"Remining blocks...")
-    for _id in blocks_ids:
-        # Updating previous_hash field 
-        db.update_previous_hash_by_id(_id, blocks_ids)
 
-        db.remine_block(_id)
+    # Remined again whenever blocks are chained meanwhile, e.g., by the mining worker
+    while True:
+        print(f"Remining blocks...")
 
-        print(SpecialChars.CHECK_MARK + f" #{_id}")
+        # Mined one after the other, each linked to the one before. Written at once, at the end.
+        # A throttled progress line is shown while each block is mined, then replaced by its check mark
+        try:
+            db.remine_blocks(
+                (block["id"] for block in db.get_all_blocks(columns = ("id",))),
+                backend     = os.environ.get("MINING_BACKEND"),
+                workers     = int(os.environ.get("MINING_WORKERS", 1)),
+                on_remined  = lambda _id: print("\r" + SpecialChars.CHECK_MARK + f" #{_id}\033[K"),
+                on_progress = print_progress
+            )
+        except ValueError as e:
+            print(f"\r{e}\033[K")
+            continue
 
-    print("Done!")
+        print("Done!")
+        return
 
 
 def send_pisiticoins(db: BlockChain, accounts_pretty: tuple) -> None:
     """
-    Prompts user for information, creates a block and chains it.
+    Prompts user for information and submits the transaction to be mined in the background.
     Uses:
         - Globals.LOGGED_IN_ACCOUNT_ID
+        - Globals.MINING_WORKER
     """
 
     while True:
@@ -554,20 +572,20 @@ def send_pisiticoins(db: BlockChain, accounts_pretty: tuple) -> None:
         "miner_id": miner_id
     }
 
+    # Queued and acknowledged at once. Globals.MINING_WORKER mines it in the background
     try:
-        create_and_chain_block(db, block_data)
+        pending_id = db.set_pending_transaction(block_data)
+        if Globals.MINING_WORKER is not None: Globals.MINING_WORKER.notify()
+
         if os.environ["PRINT_STEPS"] == "True":
-            print("Transaction complete")
+            print(f"Transaction #{pending_id} submitted. It will be chained once mined")
 
     except ValueError as e:         
         from_balance = block_data["from_id"]   
         print()
         print(f"Insufficient funds in account {from_id}. Aborting operation")
         print(f"Current balance: {db.get_account_balance(from_balance)} PisitiCoins")
-
-    # Updating the balances of accounts involved in transaction
-    for _id in (from_id, to_id, miner_id):
-        db.update_user_balance(_id)
+        print(f"Pending transactions: {db.get_pending_outgoing_amount(from_balance)} PisitiCoins")
 
 
 def show_latest_blocks(db: BlockChain) -> None:
@@ -577,7 +595,7 @@ def show_latest_blocks(db: BlockChain) -> None:
 
     while True:
         os.system(Globals.CLEAR_COMMAND)
-        amount_blocks = input("How many blocks do you wish to see? (Blank for all) ") or len(db.get_blocks_ids())
+        amount_blocks = input("How many blocks do you wish to see? (Blank for all) ") or db.get_block_count()
         
         try:
             amount_blocks = int(amount_blocks)
@@ -587,13 +605,25 @@ def show_latest_blocks(db: BlockChain) -> None:
 
     os.system(Globals.CLEAR_COMMAND)
 
-    count = 1
-    for block in db.get_all_blocks():
-        for line in get_pretty_block(block): print(line)
+    # Transactions are streamed alongside the blocks, in order of id, rather than queried block by block
+    blocks = db.get_all_blocks(page_size = max(1, min(amount_blocks, STREAM_BATCH_SIZE)))
+    transactions = db.stream_transactions()
 
-        if count >= amount_blocks: break
-        count += 1
-        print()
+    # Closing both streams, even if fewer blocks than the chain's are printed
+    try:
+        count = 1
+        for block, block_transactions in join_transactions(blocks, transactions):
+            for line in get_pretty_block(block): print(line)
+
+            if block_transactions: print("Transactions:")
+            for line in get_pretty_transactions(block_transactions): print(line)
+
+            if count >= amount_blocks: break
+            count += 1
+            print()
+    finally:
+        transactions.close()
+        blocks.close()
 
 
 def sign_up(db: BlockChain) -> None:
@@ -688,6 +718,14 @@ if __name__ == "__main__":
 
     file_name = 'db/PisitiCoin.sqlite3'
 
+    # Mines submitted transactions, including any left pending by a previous run
+    Globals.MINING_WORKER = MiningWorker(
+        file_name,
+        backend = os.environ.get("MINING_BACKEND"),
+        workers = int(os.environ.get("MINING_WORKERS", 1))
+    )
+    Globals.MINING_WORKER.start()
+
     # Interface
     while True:
         try:
@@ -696,4 +734,6 @@ if __name__ == "__main__":
         except StopIteration as e:
             break
 
+    Globals.MINING_WORKER.stop()
+
     toggle_fullscreen()
\ No newline at end of file
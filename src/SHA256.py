@@ -8,151 +8,238 @@
 #   A SHA256 hash function from scratch                             #
 #********************************************************************
 
-from math import ceil
+import struct
 
-def dec2bin_int(x):
-    return int(bin(x)[2:])
+# Step 2 - Initial Hash Values (h)
+INITIAL_HASH = (
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+)
+
+# Step 3 - Round Constants (k)
+ROUND_CONSTANTS = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+)
+
+CHUNK_SIZE = 64
+MASK_32    = 0xFFFFFFFF
 
-def str2bin_str(message):
-    return ''.join(format(ord(i), '08b') for i in message)
 
-def bin_len(x):
-    return len(bin(x)) - 2
+def right_rotate(num: int, bits: int) -> int:
+    """ Rotates a 32 bits integer to the right """
 
-# Numbers must be in a string format. "011010" -> 0b011010
-def right_rotate(num, bits):
-    bin_number_len = 32
+    return ((num >> bits) | (num << (32 - bits))) & MASK_32
 
-    num = int(num, 2)
-    right = (num >> bits)|(num << (bin_number_len - bits)) & (2**bin_number_len - 1)
-    return right
 
+def to_bytes(message) -> bytes:
+    """ Returns the bytes to be hashed. Strings are utf-8 encoded """
 
-def SHA256(message):
-    # Followed the steps from https://qvault.io/cryptography/how-sha-2-works-step-by-step-sha-256/
+    if isinstance(message, str): return message.encode("utf-8")
+
+    return bytes(message)
+
+
+def padding(size: int) -> bytes:
+    """
+    Step 1 - Pre-Processing
+    Returns what follows a message of 'size' bytes: a single 1 bit, zeros and the
+    original size in bits (64 bits, big endian), so that the total length is a multiple of 512 bits
+    """
+
+    zeros = (55 - size) % CHUNK_SIZE
+
+    return b"\x80" + b"\x00" * zeros + struct.pack(">Q", size * 8)
+
+
+def compress(state: tuple, chunk: bytes) -> tuple:
+    """
+    Runs the 64 compression rounds over one 64 bytes chunk.
+    Returns the updated state, as a tuple of eight 32 bits integers.
+    The rotations are written inline, since function calls are expensive in this hot loop
+    """
+
+    # Step 5 – Create Message Schedule (w)
+    w = list(struct.unpack(">16L", chunk))
+
+    for i in range(16, 64):
+        x  = w[i - 15]
+        s0 = ((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)
+        x  = w[i - 2]
+        s1 = ((x >> 17) | (x << 15)) ^ ((x >> 19) | (x << 13)) ^ (x >> 10)
+        w.append((w[i - 16] + (s0 & MASK_32) + w[i - 7] + (s1 & MASK_32)) & MASK_32)
+
+    # Step 6 - Compression
+    a, b, c, d, e, f, g, h = state
+
+    for i in range(64):
+        S1 = ((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))
+        ch = (e & f) ^ (~e & g)
+        temp1 = (h + (S1 & MASK_32) + ch + ROUND_CONSTANTS[i] + w[i]) & MASK_32
+
+        S0 = ((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        temp2 = (S0 & MASK_32) + maj
+
+        h = g
+        g = f
+        f = e
+        e = (d + temp1) & MASK_32
+        d = c
+        c = b
+        b = a
+        a = (temp1 + temp2) & MASK_32
+
+    # Step 7 - Modify Final Values
+    return (
+        (state[0] + a) & MASK_32,
+        (state[1] + b) & MASK_32,
+        (state[2] + c) & MASK_32,
+        (state[3] + d) & MASK_32,
+        (state[4] + e) & MASK_32,
+        (state[5] + f) & MASK_32,
+        (state[6] + g) & MASK_32,
+        (state[7] + h) & MASK_32
+    )
+
+
+class SHA256Hash():
+    """
+    Incremental SHA256, modeled on hashlib's hash objects.
+    Only the compression state and the unprocessed tail (< 64 bytes) are kept,
+    so large inputs may be fed in chunks through update().
+    A shared prefix may be absorbed once and the object cloned with copy()
+    """
+
+    name        = "sha256"
+    digest_size = 32
+    block_size  = CHUNK_SIZE
+
+    def __init__(self, message = b"") -> None:
+        self._state  = INITIAL_HASH
+        self._buffer = b""
+        self._length = 0
+
+        if message: self.update(message)
 
-    # Step 1 – Pre-Processing
-    message = str2bin_str(message)
-
-    original_size = len(message)
-
-    message += "1"
-
-    my_size = ceil(len(message) / 512) * 512 - 64
-
-    message += "0" * (my_size - (original_size + 1))
-
-    bin_original_size = dec2bin_int(original_size)
-    size_bin_original_size = sum(1 for i in bin(original_size)) - 2
-    message += "0" * (64 - size_bin_original_size)
-    message += str(bin_original_size)
-
-    # Step 2 - initialize Hash Values (h)
-    h0 = 0x6a09e667
-    h1 = 0xbb67ae85
-    h2 = 0x3c6ef372
-    h3 = 0xa54ff53a
-    h4 = 0x510e527f
-    h5 = 0x9b05688c
-    h6 = 0x1f83d9ab
-    h7 = 0x5be0cd19
 
-    # Step 3 - Initialize Round Constants (k)
-    k = [0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
-        0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
-        0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
-        0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
-        0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
-        0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
-        0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
-        0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
+    def copy(self) -> "SHA256Hash":
+        """ Returns an independent clone of the current state """
 
-    # Step 4 - Chunk Loops
-    count = 0
-    for j in range(int(len(message)/512)):
-        # Step 5 – Create Message Schedule (w)
-        w = []
+        clone = SHA256Hash.__new__(SHA256Hash)
+        clone._state  = self._state
+        clone._buffer = self._buffer
+        clone._length = self._length
 
-        for i in range(16):
-            word = ""
-            for j in range(count, count + 32):
-                word += message[j]
-            w.append(word)
-            count += 32
+        return clone
 
-        for i in range(48):
-            w.append("0"*32)
 
-        for i in range(16, 64):
-            s0 = (right_rotate(w[i - 15], 7)) ^ (right_rotate(w[i - 15], 18)) ^ (int(w[i - 15], 2) >> 3)
-            s1 = (right_rotate(w[i - 2], 17)) ^ (right_rotate(w[i - 2], 19)) ^ (int(w[i - 2], 2) >> 10)
-            w[i] = int(w[i - 16], 2) + s0 + int(w[i - 7], 2) + s1
+    def digest(self) -> bytes:
+        """ Returns the digest of everything fed so far. Does not change the object's state """
 
-            w[i] = w[i] % 0x100000000
+        # Step 1 - Pre-Processing, only over the unprocessed tail
+        tail = self._buffer + padding(self._length)
 
-            w[i] = bin(w[i])[2:]
+        state = self._state
+        for i in range(0, len(tail), CHUNK_SIZE):
+            state = compress(state, tail[i : i + CHUNK_SIZE])
 
+        return struct.pack(">8L", *state)
 
-        # Step 6 - Compression
-        a = h0
-        b = h1
-        c = h2
-        d = h3
-        e = h4
-        f = h5
-        g = h6
-        h = h7
 
-        for i in range(64):
-            S1 = (right_rotate(bin(e), 6)) ^ (right_rotate(bin(e), 11)) ^ (right_rotate(bin(e), 25))
-            ch = (e & f) ^ ((~e) & g)
-            temp1 = h + S1 + ch + k[i] + int(w[i], 2)
-            temp1 = temp1 % 0x100000000
+    def hexdigest(self) -> str:
+        """ Returns the digest as a hex string """
 
-            S0 = (right_rotate(bin(a), 2)) ^ (right_rotate(bin(a), 13)) ^ (right_rotate(bin(a), 22))
-            maj = (a & b) ^ (a & c) ^ (b & c)
-            temp2 = S0 + maj
-            temp2 = temp2 % 0x100000000
+        return self.digest().hex()
 
-            h = g
-            g = f
-            f = e
-            e = d + temp1
-            e = e % 0x100000000
 
-            d = c
-            c = b
-            b = a
-            a = temp1 + temp2
-            a = a % 0x100000000
+    def midstate(self) -> tuple:
+        """
+        Returns (state, tail, length): the compression state after every full chunk,
+        the unprocessed tail bytes and the total amount of bytes fed so far
+        """
 
-        # Step 7 - Modify Final Values
-        h0 += a
-        h0 = h0 % 0x100000000
+        return self._state, self._buffer, self._length
 
-        h1 += b
-        h1 = h1 % 0x100000000
 
-        h2 += c
-        h2 = h2 % 0x100000000
+    def update(self, message) -> None:
+        """ Feeds more data (str or bytes) into the hash """
 
-        h3 += d
-        h3 = h3 % 0x100000000
-
-        h4 += e
-        h4 = h4 % 0x100000000
-
-        h5 += f
-        h5 = h5 % 0x100000000
-
-        h6 += g
-        h6 = h6 % 0x100000000
-
-        h7 += h
-        h7 = h7 % 0x100000000
-
-    return format(h0, '#010x')[2:] + format(h1, '#010x')[2:] + format(h2, '#010x')[2:] + format(h3, '#010x')[2:] + format(h4, '#010x')[2:] + format(h5, '#010x')[2:] + format(h6, '#010x')[2:] + format(h7, '#010x')[2:]
+        message = to_bytes(message)
+        self._length += len(message)
+
+        # Completing the pending chunk first
+        if self._buffer:
+            needed = CHUNK_SIZE - len(self._buffer)
+            self._buffer += message[:needed]
+            message = message[needed:]
+
+            if len(self._buffer) < CHUNK_SIZE: return
+
+            self._state  = compress(self._state, self._buffer)
+            self._buffer = b""
+
+        # Step 4 - Chunk Loops. A memoryview avoids copying large inputs on every slice
+        view = memoryview(message)
+        full_size = len(message) - len(message) % CHUNK_SIZE
+        state = self._state
+        for i in range(0, full_size, CHUNK_SIZE):
+            state = compress(state, view[i : i + CHUNK_SIZE])
+
+        self._state  = state
+        self._buffer = bytes(view[full_size:])
+
+
+def sha256_digest(message) -> bytes:
+    """ Returns the 32 bytes digest of a message (str or bytes) """
+
+    return SHA256Hash(message).digest()
+
+
+def SHA256(message) -> str:
+    """ Returns the hex digest of a message (str or bytes) """
+
+    # Followed the steps from https://qvault.io/cryptography/how-sha-2-works-step-by-step-sha-256/
+    return sha256_digest(message).hex()
+
+
+def parity_check(amount: int = 5000, max_size: int = 300) -> None:
+    """
+    Compares this implementation against hashlib's over random inputs.
+    Raises AssertionError on the first mismatch
+    """
+
+    import hashlib
+    import os
+    import random
+
+    for _ in range(amount):
+        message = os.urandom(random.randint(0, max_size))
+        expected = hashlib.sha256(message).hexdigest()
+
+        if SHA256(message) != expected:
+            raise AssertionError(f"Mismatch for message {message.hex()}")
+
+        # Same message, fed in random pieces
+        hasher = SHA256Hash()
+        start = 0
+        while start < len(message):
+            end = start + random.randint(1, 2 * CHUNK_SIZE)
+            hasher.update(message[start:end])
+            start = end
+
+        if hasher.copy().hexdigest() != expected:
+            raise AssertionError(f"Incremental mismatch for message {message.hex()}")
 
 
 if __name__ == "__main__":
+    parity_check()
+    print("Parity with hashlib.sha256: OK")
+
     print(SHA256("In the case of an infinitesimally small elastic sphere, the effect of a tidal force is to distort the shape of the body without any change in volume. The sphere becomes an ellipsoid with two bulges, pointing towards and away from the other body. Larger objects distort into an ovoid, and are slightly compressed, which is what happens to the Earth's oceans under the action of the Moon. The Earth and Moon rotate about their common center of mass or barycenter, and their gravitational attraction provides the centripetal force necessary to maintain this motion. To an observer on the Earth, very close to this barycenter, the situation is one of the Earth as body 1 acted upon by the gravity of the Moon as body 2. All parts of the Earth are subject to the Moon's gravitational forces, causing the water in the oceans to redistribute, forming bulges on the sides near the Moon and far from the Moon."))
\ No newline at end of file
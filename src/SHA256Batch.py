@@ -0,0 +1,206 @@
+#********************************************************************
+# Author: Lauro França (oPisiti)                                    #
+# Contact:                                                          #
+#   github: oPisiti                                                 #
+#   Email: contact@opisiti.com                                      #
+# Date: May, 2023                                                   #
+# Description:                                                      #
+#   A lane parallel SHA256, hashing batches of messages that share  #
+#   a prefix at once, with numpy uint32 arrays                      #
+#********************************************************************
+
+from SHA256 import CHUNK_SIZE, ROUND_CONSTANTS, SHA256Hash, padding
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NUMPY_AVAILABLE = np is not None
+
+# Default amount of nonces hashed per batch when mining
+BATCH_SIZE = 4096
+
+
+def require_numpy() -> None:
+    """ Raises ImportError if numpy is not installed """
+
+    if not NUMPY_AVAILABLE:
+        raise ImportError("The batch SHA256 requires numpy. Install it with 'pip install numpy'")
+
+
+def rotr(x, bits: int):
+    """ Rotates every 32 bits lane to the right """
+
+    return (x >> bits) | (x << (32 - bits))
+
+
+def compress_lanes(state: list, words):
+    """
+    Runs the 64 compression rounds over one chunk per lane.
+    state: list of eight uint32 arrays of shape (N,)
+    words: uint32 array of shape (N, 16)
+    Returns the updated state, as a list of eight uint32 arrays of shape (N,)
+    """
+
+    # Step 5 – Create Message Schedule (w)
+    w = [words[:, i] for i in range(16)]
+
+    for i in range(16, 64):
+        s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >> 3)
+        s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >> 10)
+        w.append(w[i - 16] + s0 + w[i - 7] + s1)
+
+    # Step 6 - Compression. uint32 arithmetic wraps around on its own
+    a, b, c, d, e, f, g, h = state
+
+    for i in range(64):
+        S1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+        ch = (e & f) ^ (~e & g)
+        temp1 = h + S1 + ch + np.uint32(ROUND_CONSTANTS[i]) + w[i]
+
+        S0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        temp2 = S0 + maj
+
+        h = g
+        g = f
+        f = e
+        e = d + temp1
+        d = c
+        c = b
+        b = a
+        a = temp1 + temp2
+
+    # Step 7 - Modify Final Values
+    return [old + new for old, new in zip(state, (a, b, c, d, e, f, g, h))]
+
+
+def sha256_batch(prefix, suffixes):
+    """
+    Hashes N messages that share a prefix, one per lane.
+    prefix:   bytes or a SHA256Hash which already absorbed the shared prefix
+    suffixes: uint8 array of shape (N, k), the bytes appended to the prefix on every lane
+    Returns a uint32 array of shape (N, 8) with every lane's digest words
+    """
+
+    require_numpy()
+
+    if not isinstance(prefix, SHA256Hash): prefix = SHA256Hash(prefix)
+    state, tail, length = prefix.midstate()
+
+    lanes, suffix_size = suffixes.shape
+    head    = np.frombuffer(tail, dtype = np.uint8)
+    trailer = np.frombuffer(padding(length + suffix_size), dtype = np.uint8)
+
+    # Step 1 - Pre-Processing. Every lane has the same layout: tail, suffix, padding
+    message = np.empty((lanes, len(tail) + suffix_size + len(trailer)), dtype = np.uint8)
+    message[:, :len(tail)] = head
+    message[:, len(tail) : len(tail) + suffix_size] = suffixes
+    message[:, len(tail) + suffix_size:] = trailer
+
+    words = message.view(">u4").astype(np.uint32)
+
+    # Step 4 - Chunk Loops
+    lanes_state = [np.full(lanes, x, dtype = np.uint32) for x in state]
+    for i in range(0, words.shape[1], CHUNK_SIZE // 4):
+        lanes_state = compress_lanes(lanes_state, words[:, i : i + CHUNK_SIZE // 4])
+
+    return np.stack(lanes_state, axis = 1)
+
+
+def nonce_range(start: int, size: int):
+    """ Returns the vector of nonces [start, start + size) """
+
+    require_numpy()
+
+    return np.arange(start, start + size, dtype = np.uint64)
+
+
+def nonces_to_suffixes(nonces):
+    """ Returns the nonces packed as big endian, unsigned 64 bits integers: uint8 array of shape (N, 8) """
+
+    require_numpy()
+
+    return np.asarray(nonces, dtype = ">u8").view(np.uint8).reshape(-1, 8)
+
+
+def target_mask(digests, target: int):
+    """
+    Returns a boolean array telling which lanes' digests, read as 256 bits big endian integers, are <= target.
+    digests: uint32 array of shape (N, 8)
+    """
+
+    target_words = [(target >> (32 * (7 - i))) & 0xFFFFFFFF for i in range(8)]
+
+    below = np.zeros(digests.shape[0], dtype = bool)
+    equal = np.ones(digests.shape[0], dtype = bool)
+
+    # Compared word by word, from the most significant one
+    for i, word in enumerate(target_words):
+        below |= equal & (digests[:, i] < np.uint32(word))
+        equal &= digests[:, i] == np.uint32(word)
+
+    return below | equal
+
+
+def mine_nonces(prefix, nonces, target: int):
+    """
+    Hashes the prefix followed by every nonce (fixed width, 64 bits, big endian).
+    Returns (lanes, digests): the indexes of the lanes whose hash is <= target, and every lane's digest words
+    """
+
+    digests = sha256_batch(prefix, nonces_to_suffixes(nonces))
+
+    return np.flatnonzero(target_mask(digests, target)), digests
+
+
+def bytes_to_suffixes(suffixes: list):
+    """ Returns equally sized byte strings as a uint8 array of shape (N, k), one per lane """
+
+    require_numpy()
+
+    return np.frombuffer(b"".join(suffixes), dtype = np.uint8).reshape(len(suffixes), -1)
+
+
+def digest_to_hex(digest_words) -> str:
+    """ Returns a lane's digest words as a hex string """
+
+    return "".join(format(int(x), "08x") for x in digest_words)
+
+
+if __name__ == "__main__":
+    import hashlib
+    import os
+    import time
+
+    require_numpy()
+
+    # Parity with hashlib, for prefixes of several sizes
+    for size in range(0, 200, 7):
+        prefix = os.urandom(size)
+        nonces = nonce_range(1000, 64)
+        digests = sha256_batch(prefix, nonces_to_suffixes(nonces))
+
+        for nonce, digest in zip(nonces, digests):
+            expected = hashlib.sha256(prefix + int(nonce).to_bytes(8, "big")).hexdigest()
+            if digest_to_hex(digest) != expected:
+                raise AssertionError(f"Mismatch for prefix of size {size} and nonce {nonce}")
+
+    print("Parity with hashlib.sha256: OK")
+
+    # Targets, compared as integers
+    digests = sha256_batch(b"", nonces_to_suffixes(nonce_range(0, 256)))
+    for target in (0, 2**200, 2**248 - 1, int(digest_to_hex(digests[0]), 16), 2**256 - 1):
+        expected = [int(digest_to_hex(digest), 16) <= target for digest in digests]
+        if list(target_mask(digests, target)) != expected:
+            raise AssertionError(f"Target mask mismatch for target {target:#066x}")
+
+    print("Target comparison: OK")
+
+    # Throughput
+    prefix = SHA256Hash(os.urandom(150))
+    start = time.perf_counter()
+    for i in range(10):
+        mine_nonces(prefix, nonce_range(i * BATCH_SIZE, BATCH_SIZE), 2**240 - 1)
+    print(f"{10 * BATCH_SIZE / (time.perf_counter() - start):.0f} H/s")
@@ -7,34 +7,377 @@
 # Description:                                                      #
 #   A library of helper functions for PisitiCoins                   #
 #********************************************************************
+import contextlib
+import itertools
+import multiprocessing
 import os
 import sqlite3
+import struct
+import threading
 
-from SHA256 import *
+from concurrent.futures import ProcessPoolExecutor
+from ConnectionPool import MEMORY_DB_PATH, ConnectionPool, MemoryConnectionPool, ReadOnlyConnectionPool
+from HashBackends import HashBackend, get_backend
+from Mining import HEADER_NONCE_FORMAT, MiningStats, mine_parallel, print_progress, search_with_stats
 from typing import Any
 
+
+# Target of every block mined before targets were stored: 2 leading hex zeros
+LEGACY_TARGET = 2**248 - 1
+
+# Default difficulty settings of a chain. See BlockChain
+TARGET_MINING_TIME  = 2.0   # Seconds. Desired average mining time
+RETARGET_WINDOW     = 10    # Amount of latest blocks whose mining times the hashrate is estimated from
+MAX_RETARGET_FACTOR = 4     # The target changes by, at most, this factor at a time
+
+# Header layouts understood by Block.det_hash()
+HEADER_VERSIONS = (1, 2, 3, 4)
+
+# Rows fetched at a time when streaming the chain
+STREAM_BATCH_SIZE = 1024
+
+# Amount of consecutive blocks handed to a worker process at a time, when checking the chain in parallel
+VERIFY_CHUNK_SIZE = 4096
+
+# Relative database paths are relative to it. See BlockChain
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# The first block of a chain. It has no block before it: its previous hash is zeros. See BlockChain.verify_block()
+GENESIS_BLOCK_ID      = 0
+GENESIS_PREVIOUS_HASH = "0x" + "00" * 32
+
+# Widest range of block ids. See BlockChain.stream_blocks()
+MIN_BLOCK_ID = -2**63
+MAX_BLOCK_ID = 2**63 - 1
+
+# Block columns holding a 256 bits value as "0x" followed by 64 hex digits. Stored as 32 bytes. See encode_hash()
+HASH_COLUMNS = ("previous_hash", "hash", "target", "merkle_root")
+
+
+# Balance of an account, summed from the chain. See BlockChain.det_account_balance() and account_balance_plan_check().
+# UNION ALL, not UNION: equal amounts must not be merged
+ACCOUNT_BALANCE_QUERY = """
+SELECT COALESCE(SUM(delta), 0)
+  FROM (
+        SELECT :opening_balance AS delta FROM accounts          WHERE id        = :account_id
+        UNION ALL
+        SELECT -amount          FROM block_store       WHERE from_key  = (SELECT key FROM account_keys WHERE id = :account_id)
+        UNION ALL
+        SELECT amount           FROM block_store       WHERE to_key    = (SELECT key FROM account_keys WHERE id = :account_id)
+        UNION ALL
+        SELECT miner_reward     FROM block_store       WHERE miner_key = (SELECT key FROM account_keys WHERE id = :account_id)
+        UNION ALL
+        SELECT -amount          FROM transaction_store WHERE from_key  = (SELECT key FROM account_keys WHERE id = :account_id)
+        UNION ALL
+        SELECT amount           FROM transaction_store WHERE to_key    = (SELECT key FROM account_keys WHERE id = :account_id)
+       )
+"""
+
+
+def format_target(target: int) -> str:
+    """ Returns a target the way it is stored: "0x" followed by 64 hex digits """
+
+    return "0x" + format(target, "064x")
+
+
+def encode_hash(value: Any) -> Any:
+    """
+    Returns a hash ("0x" followed by 64 lower case hex digits) the way it is stored: its 32 bytes.
+    Any other value, e.g., edited by hand, is returned as it is, so that it is read back unchanged. See decode_hash_sql()
+    """
+
+    if not isinstance(value, str) or len(value) != 66 or not value.startswith("0x"): return value
+
+    try:
+        raw = bytes.fromhex(value[2:])
+    except ValueError:
+        return value
+
+    # Only values which are read back exactly as they were written
+    return raw if "0x" + raw.hex() == value else value
+
+
+def decode_hash_sql(column: str) -> str:
+    """ Returns the sql expression which reads a column stored by encode_hash() back as its original value """
+
+    return f"CASE typeof({column}) WHEN 'blob' THEN '0x' || lower(hex({column})) ELSE {column} END"
+
+
+def pack_str(string: str) -> bytes:
+    """ Packs a string as its utf-8 bytes, prefixed by their length (unsigned 16 bits, big endian) """
+
+    encoded = string.encode("utf-8")
+
+    return struct.pack(">H", len(encoded)) + encoded
+
+
+def pack_transaction(transaction: dict) -> bytes:
+    """ Canonical binary packing of a transaction: from_id, to_id and amount """
+
+    return  pack_str(transaction["from_id"]) + \
+            pack_str(transaction["to_id"]) + \
+            struct.pack(">d", transaction["amount"])
+
+
+def det_expected_hashes(target: int) -> int:
+    """ Returns the amount of hashes a block is expected to take, on average, to meet a target: 2**256 / (target + 1) """
+
+    return 2**256 // (target + 1)
+
+
+def det_merkle_root(transactions: list, hash_backend: HashBackend) -> str:
+    """
+    Returns the merkle root ("0x...") of a list of transactions, in order.
+    Leaves are the hashes of the packed transactions. Each level hashes the concatenation of pairs,
+    the last hash of an odd level being paired with itself.
+    The root is the hash of the amount of transactions (unsigned 64 bits, big endian) followed by the tree's top hash:
+    otherwise, duplicating the last transaction of an odd level would keep the root.
+    The root of no transactions is 32 zero bytes
+    """
+
+    level = [hash_backend.new(pack_transaction(t)).digest() for t in transactions]
+    if not level: return "0x" + "00" * 32
+
+    while len(level) > 1:
+        if len(level) % 2: level.append(level[-1])
+        level = [hash_backend.new(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+
+    return "0x" + hash_backend.new(struct.pack(">Q", len(transactions)) + level[0]).hexdigest()
+
+
+def join_transactions(blocks, transactions):
+    """
+    Merges two streams, both in order of block id:
+        - blocks: blocks (dicts or BlockRecord);
+        - transactions: (block id, list of transactions). See BlockChain.stream_transactions()
+    Returns an iterator over (block, list of its transactions). Blocks without transactions get an empty list
+    """
+
+    next_transactions = next(transactions, None)
+
+    for block in blocks:
+        # Skipping transactions of blocks not in the stream, e.g., deleted ones
+        while next_transactions is not None and next_transactions[0] < block["id"]:
+            next_transactions = next(transactions, None)
+
+        if next_transactions is not None and next_transactions[0] == block["id"]:
+            yield block, next_transactions[1]
+        else:
+            yield block, []
+
+
+def stream_query(conn: sqlite3.Connection, query: str, parameters: tuple = (), batch_size: int = STREAM_BATCH_SIZE, row_factory = sqlite3.Row):
+    """
+    Returns an iterator over the rows of a query, fetched batch_size at a time through a cursor of its own.
+    row_factory: what each row is built as. E.g., BlockRecord.from_row
+    The cursor is closed once the iterator is exhausted or discarded
+    """
+
+    cursor = conn.cursor()
+    cursor.row_factory = row_factory
+
+    try:
+        cursor.execute(query, parameters)
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows: return
+
+            yield from rows
+    finally:
+        cursor.close()
+
+
+# The chain checked by a worker process, through its only connection. See _init_verify_worker()
+_verify_worker_db = None
+
+
+def _init_verify_worker(db_path: str, hash_backend_name: str) -> None:
+    """
+    Initializer of every worker process checking the chain in parallel: opens its only connection to the database, once.
+    Read only: nothing is migrated nor locked, so checks run alongside writers. The difficulty settings are read from the chain.
+    See BlockChain.check_blocks_range()
+    """
+
+    global _verify_worker_db
+    _verify_worker_db = BlockChain(db_path, path_is_relative = False, hash_backend = hash_backend_name, read_only = True)
+
+
+def _verify_worker(first_id: int, last_id: int) -> int:
+    """ Checks the blocks with ids in [first_id, last_id] in a worker process. See _init_verify_worker() """
+
+    return _verify_worker_db.check_blocks_range(first_id, last_id)
+
+
+class BlockRecord():
+    """
+    A block read from the database, built straight from its row by a row factory (see from_row()).
+    Its columns are attributes held in __slots__, rather than a dict per block: block.hash.
+    They are also read and written by key, as the CLI does: block["hash"], block.keys(), dict(block)
+    """
+
+    __slots__ = (
+        "_keys",
+        "id",
+        "previous_hash",
+        "from_id",
+        "to_id",
+        "amount",
+        "miner_id",
+        "miner_reward",
+        "nonce",
+        "hash",
+        "version",
+        "target",
+        "mining_time",
+        "merkle_root",
+        "previous_id"
+    )
+
+    # (cursor description, column names) of the latest query built from. See from_row()
+    _columns_cache = (None, ())
+
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+
+    def __getitem__(self, key: str) -> Any:
+        """ Raises KeyError if the column was not queried """
+
+        if key not in self._keys: raise KeyError(key)
+
+        return getattr(self, key)
+
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+    def __repr__(self) -> str:
+        return f"BlockRecord({', '.join(f'{key}={getattr(self, key)!r}' for key in self._keys)})"
+
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        """ Raises KeyError if a block has no such column """
+
+        if key not in self.__slots__[1:]: raise KeyError(key)
+
+        if key not in self._keys: self._keys += (key,)
+        setattr(self, key, value)
+
+
+    @classmethod
+    def from_row(cls, cursor: sqlite3.Cursor, row: tuple) -> "BlockRecord":
+        """ Row factory: cursor.row_factory = BlockRecord.from_row. The row's columns must be block columns """
+
+        # Every row of a query shares its description: the column names are only read once per query
+        description, keys = cls._columns_cache
+        if description is not cursor.description:
+            keys = tuple(column[0] for column in cursor.description)
+            cls._columns_cache = (cursor.description, keys)
+
+        record = cls.__new__(cls)
+        record._keys = keys
+        for key, value in zip(keys, row): setattr(record, key, value)
+
+        return record
+
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self._keys else default
+
+
+    def items(self) -> tuple:
+        return tuple((key, getattr(self, key)) for key in self._keys)
+
+
+    def keys(self) -> tuple:
+        """ The columns queried, in order """
+
+        return self._keys
+
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, key) for key in self._keys)
+
+
 class BlockChain():
-    def __init__(self, db_path: str, path_is_relative = True) -> None:
-        # Changing the current directory in order to use a relative path to the database
-        if path_is_relative:
-            os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    def __init__(
+        self,
+        db_path: str,
+        path_is_relative = True,
+        hash_backend: str = None,
+        read_only = False,
+        max_target: int = None,
+        target_mining_time: float = None,
+        retarget_window: int = None,
+        max_retarget_factor: int = None
+    ) -> None:
+        """
+        Connects to a database and brings its schema up to date.
+        db_path: path to a database file, relative to the project's root if path_is_relative.
+                 Or ":memory:" (MEMORY_DB_PATH), for an empty database held in memory only, e.g., for tests and benchmarks. See MemoryConnectionPool
+        hash_backend: name of the SHA256 backend used to verify and mine blocks. See HashBackends.get_backend().
+                      Defaults to the HASH_BACKEND environment variable, then to the fastest backend passing its self test
+        read_only: if True, connects to a database file through a single connection which only reads, e.g., from worker processes.
+                   Its schema is not migrated: it must already be up to date. Writes raise sqlite3.OperationalError. See ReadOnlyConnectionPool
+        Difficulty. Stored along with the chain: each one not given is read from it, else defaults. See _load_difficulty() and det_next_target():
+            max_target:          easiest target allowed, checked by verify_block(). Up to 2**256 - 1, which any hash meets. Defaults to LEGACY_TARGET;
+            target_mining_time:  seconds. Desired average mining time. 0 keeps every target at max_target, e.g., for benchmarks. Defaults to TARGET_MINING_TIME;
+            retarget_window:     amount of latest blocks whose mining times the hashrate is estimated from. Defaults to RETARGET_WINDOW;
+            max_retarget_factor: the target changes by, at most, this factor at a time. Defaults to MAX_RETARGET_FACTOR.
+        Raises ValueError if a difficulty setting is out of range
+        """
 
-        # Check if the databprevious hashase file exists
-        if not os.path.exists(db_path):
-            raise FileNotFoundError(f"File {db_path} does not exist")
+        in_memory = db_path == MEMORY_DB_PATH
 
-        # Trying to connect to database
-        self.conn = sqlite3.connect(db_path)      
+        if not in_memory:
+            # Whatever the current directory is
+            if path_is_relative: db_path = os.path.join(PROJECT_ROOT, db_path)
 
-        # Testing connection
-        self.cursor = self.conn.cursor()
+            # Check if the database file exists
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(f"File {db_path} does not exist")
+
+            # Worker processes open their own connection, wherever their current directory is
+            db_path = os.path.realpath(db_path)
+
+        self.db_path = db_path
+
+        # Trying to connect to database, and testing the connection.
+        # Rows are returned as dictionaries - For get methods
         try:
-            self.cursor.execute("SELECT id FROM accounts")
+            if   in_memory: self.pool = MemoryConnectionPool()
+            elif read_only: self.pool = ReadOnlyConnectionPool(self.db_path)
+            else:           self.pool = ConnectionPool(self.db_path)
+
+            # A database in memory starts empty
+            if in_memory: self._create_base_schema()
+
+            self.pool.writer.execute("SELECT id FROM accounts")
         except sqlite3.Error as e:
             raise FileExistsError("Connection to the database unsuccessful")
 
-        # Configure the cursor to return rows as dictionaries - For get methods
-        self.cursor.row_factory = sqlite3.Row
+        # Every write goes through the pool's single writer, holding its lock. See batch()
+        self.conn   = self.pool.writer
+        self.cursor = self.conn.cursor()
+
+        # Amount of nested batch() scopes currently open, and the thread which opened them. See batch()
+        self._batch_depth  = 0
+        self._batch_thread = None
+
+        # Constants
+        self.INIT_BALANCE = 10_000      # Granted to every new account. Balances are summed from it: migrations need it
+
+        if not read_only: self.migrate_schema()
+
+        # Self tested on first use
+        self.hash_backend: HashBackend = get_backend(hash_backend)
 
         self.block_chain_columns = {
             "previous_hash",
@@ -44,20 +387,299 @@ class BlockChain():
             "miner_id",
             "miner_reward",
             "nonce",
-            "hash"        
+            "hash",
+            "version",
+            "target",
+            "mining_time",
+            "merkle_root"
         }
 
-        # Constants
-        self.INIT_BALANCE = 10_000
+        # Difficulty. A block is valid if its hash, read as a 256 bits integer, is <= its target
+        self._load_difficulty(
+            store               = not read_only,
+            max_target          = max_target,
+            target_mining_time  = target_mining_time,
+            retarget_window     = retarget_window,
+            max_retarget_factor = max_retarget_factor
+        )
 
 
     def __del__(self) -> None:
-        # Close the cursor and the database connection
+        # Nothing to close if the constructor raised before connecting
+        if not hasattr(self, "cursor"): return
+
+        # Close the cursor and every database connection
         self.cursor.close()
-        self.conn.close()
+        self.pool.close()
+
+
+    def _apply_block_balances(self, block: dict, transactions: list = ()) -> None:
+        """
+        Applies a new block's transfers, in order, and its miner reward to the balances of the accounts involved.
+        Each sender must hold more than it sends, checked and debited in a single statement.
+        Does not commit: meant to run in the transaction which writes the block.
+        Raises ValueError if a sender can not afford its transfer
+        """
+
+        transfers = transactions if block["merkle_root"] is not None else (block,)
+
+        for t in transfers:
+            self.cursor.execute(
+                """
+                UPDATE accounts
+                   SET balance = balance - :amount
+                 WHERE id = :from_id
+                   AND balance > :amount
+                """,
+                {"amount": t["amount"], "from_id": t["from_id"]}
+            )
+
+            if self.cursor.rowcount == 0:
+                raise ValueError(f"Insufficient funds on account {t['from_id']}. Required cash: {t['amount']}")
+
+            self.cursor.execute("UPDATE accounts SET balance = balance + ? WHERE id = ?", (t["amount"], t["to_id"]))
+
+        self.cursor.execute("UPDATE accounts SET balance = balance + ? WHERE id = ?", (block["miner_reward"], block["miner_id"]))
+
+
+    def _get_block_accounts(self, block_id: int) -> set:
+        """ Returns the ids of every account involved in a block: senders, receivers and miner """
+
+        cursor = self._reader().execute(
+            """
+            SELECT from_id, to_id, miner_id FROM block_chain  WHERE id = :block_id
+            UNION ALL
+            SELECT from_id, to_id, NULL     FROM transactions WHERE block_id = :block_id
+            """,
+            {"block_id": block_id}
+        )
+
+        return {_id for row in cursor.fetchall() for _id in row if _id is not None}
+
+
+    def _load_difficulty(self, store: bool, **settings) -> None:
+        """
+        Sets MAX_TARGET, TARGET_MINING_TIME, RETARGET_WINDOW and MAX_RETARGET_FACTOR: each one given, else the one stored in the
+        "chain_metadata" table, else its default. Unless store is False, they are then stored, so that every connection to the chain,
+        worker processes included, verifies and retargets its blocks alike.
+        Changing the maximum target discards the verification checkpoint: blocks found consistent before may no longer be.
+        Raises ValueError if a setting is out of range
+        """
+
+        defaults = {
+            "max_target":          LEGACY_TARGET,
+            "target_mining_time":  TARGET_MINING_TIME,
+            "retarget_window":     RETARGET_WINDOW,
+            "max_retarget_factor": MAX_RETARGET_FACTOR
+        }
+
+        # The maximum target does not fit in an sqlite integer: it is stored as the targets of blocks are. See format_target()
+        stored = {key: self.get_metadata(key) for key in defaults}
+        if stored["max_target"] is not None: stored["max_target"] = int(stored["max_target"], 16)
+
+        for key, default in defaults.items():
+            if settings[key] is None: settings[key] = default if stored[key] is None else stored[key]
+
+        if not 1 <= settings["max_target"] < 2**256: raise ValueError(f"max_target must be in [1, 2**256 - 1]. Got {settings['max_target']}")
+        if settings["target_mining_time"] < 0:       raise ValueError(f"target_mining_time can not be negative. Got {settings['target_mining_time']}")
+        if settings["retarget_window"] < 1:          raise ValueError(f"retarget_window must be at least 1. Got {settings['retarget_window']}")
+        if settings["max_retarget_factor"] < 1:      raise ValueError(f"max_retarget_factor must be at least 1. Got {settings['max_retarget_factor']}")
+
+        self.MAX_TARGET          = settings["max_target"]
+        self.TARGET_MINING_TIME  = settings["target_mining_time"]
+        self.RETARGET_WINDOW     = settings["retarget_window"]
+        self.MAX_RETARGET_FACTOR = settings["max_retarget_factor"]
+
+        if not store or settings == stored: return
+
+        with self.batch():
+            if stored["max_target"] is not None and stored["max_target"] != self.MAX_TARGET: self.set_checkpoint(None, None)
+
+            for key, value in settings.items():
+                self.set_metadata(key, format_target(value) if key == "max_target" else value)
+
+
+    def _reader(self) -> sqlite3.Connection:
+        """
+        Returns the connection reads go through: the writer, inside a batch opened by the calling thread, so that its writes not yet committed are seen.
+        Otherwise, the calling thread's pooled reader, which neither waits for writes nor blocks them. See ConnectionPool
+        """
+
+        if self._batch_thread == threading.get_ident(): return self.conn
+
+        return self.pool.reader()
+
+
+    def _refresh_balances(self, account_ids) -> None:
+        """ 
+        Sums the balances of some accounts from the chain again. See det_account_balance().
+        Does not commit: meant to run in the transaction which changes blocks already chained
+        """
+
+        self.cursor.executemany(
+            """
+            UPDATE accounts
+               SET balance = ?
+             WHERE id = ?
+            """,
+            [(self.det_account_balance(account_id), account_id) for account_id in account_ids]
+        )
+
+
+    def _write_all_balances(self) -> None:
+        """ See update_all_balances(). Does not commit """
+
+        # Every opening balance, transfer and reward, as (account, signed amount). Blocks of many transactions have no transfer of their own
+        self.cursor.execute(
+            """
+            SELECT account_id, SUM(delta) AS balance
+              FROM (
+                    SELECT id       AS account_id, :opening_balance AS delta FROM accounts
+                    UNION ALL
+                    SELECT from_id,  -amount          FROM block_chain  WHERE from_id IS NOT NULL
+                    UNION ALL
+                    SELECT to_id,    amount           FROM block_chain  WHERE to_id   IS NOT NULL
+                    UNION ALL
+                    SELECT miner_id, miner_reward     FROM block_chain
+                    UNION ALL
+                    SELECT from_id,  -amount          FROM transactions
+                    UNION ALL
+                    SELECT to_id,    amount           FROM transactions
+                   )
+             GROUP BY account_id
+            """,
+            {"opening_balance": self.INIT_BALANCE}
+        )
+
+        balances = {row["account_id"]: row["balance"] for row in self.cursor.fetchall()}
+
+        self.cursor.execute("SELECT id FROM accounts")
+        user_balances = [(balances[row["id"]], row["id"]) for row in self.cursor.fetchall()]
+
+        self.cursor.executemany(
+            """
+            UPDATE accounts
+               SET balance = ?
+             WHERE id = ?
+            """,
+            user_balances
+        )
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        A unit of work: 
+            with db.batch():
+                ...
+        Every write inside it is committed once, at its end, or rolled back as a whole if an exception is raised.
+        The outermost batch holds the write lock from its start (BEGIN IMMEDIATE).
+        Batches may be nested, e.g., every method which writes opens one: an inner batch is a savepoint, 
+        so that an exception caught inside the outer batch only undoes the inner batch's writes.
+        Other threads sharing this object wait for the outermost batch to end. Reads inside it see its writes (see _reader())
+        """
+
+        self.pool.write_lock.acquire()
+
+        try:
+            savepoint = f"batch_{self._batch_depth}"
+
+            if self._batch_depth == 0:
+                # Writes made outside of any batch, not committed yet, become part of this one
+                if not self.conn.in_transaction: self.cursor.execute("BEGIN IMMEDIATE")
+                self._batch_thread = threading.get_ident()
+            else:
+                self.cursor.execute(f"SAVEPOINT {savepoint}")
+
+            self._batch_depth += 1
+
+            try:
+                yield self
+
+            except BaseException:
+                self._batch_depth -= 1
+
+                if self._batch_depth == 0:
+                    self.conn.rollback()
+                else:
+                    self.cursor.execute(f"ROLLBACK TO {savepoint}")
+                    self.cursor.execute(f"RELEASE {savepoint}")
+
+                raise
+
+            self._batch_depth -= 1
+
+            if self._batch_depth == 0: self.conn.commit()
+            else:                      self.cursor.execute(f"RELEASE {savepoint}")
+
+        finally:
+            if self._batch_depth == 0: self._batch_thread = None
+            self.pool.write_lock.release()
 
 
-    def check_chain_health(self, check_amount: int) -> int:
+    def check_blocks_range(self, first_id: int = MIN_BLOCK_ID, last_id: int = MAX_BLOCK_ID, workers: int = 1) -> int:
+        """
+        Checks the blocks with ids in [first_id, last_id], in order, linking the first one to the block right before it.
+        Returns the lowest id of an inconsistent block. Returns None if none was found.
+        The blocks are streamed, so memory usage does not grow with the range
+        workers: if > 1, the blocks are split in chunks of VERIFY_CHUNK_SIZE, checked by this many processes.
+            The lowest inconsistent id is still the one returned. Ignored for databases held in memory
+        """
+
+        # Worker processes can not open a database held in memory
+        if workers > 1 and not self.pool.in_memory: return self._check_blocks_range_parallel(first_id, last_id, workers)
+
+        cursor = self._reader().execute(
+            """
+            SELECT *
+              FROM block_chain
+             WHERE id < ?
+             ORDER BY id DESC
+             LIMIT 1
+            """,
+            (first_id,)
+        )
+
+        cursor.row_factory = BlockRecord.from_row
+        previous_block = cursor.fetchone()
+
+        broken_ids = self.det_broken_blocks_ids(self.stream_blocks(first_id, last_id), previous_block)
+
+        try:
+            return next(broken_ids, None)
+        finally:
+            broken_ids.close()
+
+
+    def _check_blocks_range_parallel(self, first_id: int, last_id: int, workers: int) -> int:
+        """ See check_blocks_range() """
+
+        # The first id of every chunk. The last chunk goes until last_id
+        ids = (row["id"] for row in stream_query(self._reader(), "SELECT id FROM block_chain WHERE id BETWEEN ? AND ? ORDER BY id", (first_id, last_id)))
+        chunks_first_ids = list(itertools.islice(ids, 0, None, VERIFY_CHUNK_SIZE))
+        chunks_last_ids  = [_id - 1 for _id in chunks_first_ids[1:]] + [last_id]
+
+        # Forked processes would inherit this connection's locks. Spawned ones start clean, each opening a single read only connection
+        with ProcessPoolExecutor(
+            max_workers = workers,
+            mp_context  = multiprocessing.get_context("spawn"),
+            initializer = _init_verify_worker,
+            initargs    = (self.db_path, self.hash_backend.name)
+        ) as executor:
+            futures = [executor.submit(_verify_worker, first, last) for first, last in zip(chunks_first_ids, chunks_last_ids)]
+
+            # In order of chunk: a broken block is only the lowest once every chunk before it is known to be healthy
+            try:
+                for future in futures:
+                    broken_id = future.result()
+                    if broken_id is not None: return broken_id
+            finally:
+                for future in futures: future.cancel()
+
+        return None
+
+
+    def check_chain_health(self, check_amount: int, workers: int = 1) -> int:
         """
         Checks a certain amount of blocks.
         Returns the block id in which an inconsistency has been found.
@@ -65,225 +687,1572 @@ class BlockChain():
         check_amount:
             - If >=0: Checks start at block (n - check-amount - 1)
             - If < 0: Checks every block, starting with the first
+        workers: see check_blocks_range()
+        Checks of the whole chain also move the verification checkpoint. See update_checkpoint()
         """
 
-        # List of blocks ids to be checked
-        block_id_tuple_full = self.get_blocks_ids()
-        if   check_amount > 0:  block_id_tuple = block_id_tuple_full[-check_amount::]
-        elif check_amount == 0: return None
-        else:                   block_id_tuple = block_id_tuple_full
+        if check_amount == 0: return None
 
-        # Hashing each block by passing their data into a tmp block
-        tmp_data = {
-            "from_id": None,
-            "to_id": None,
-            "amount": None,
-            "miner_id": None
-            }
+        tip = self.get_tip()
+        if tip is None: return None
 
-        tmp_block = Block(self, tmp_data)
+        # The first block checked
+        first_id = MIN_BLOCK_ID
+        if check_amount > 0:
+            cursor = self._reader().execute(
+                """
+                SELECT id
+                  FROM block_chain
+                 ORDER BY id DESC
+                 LIMIT 1 OFFSET ?
+                """,
+                (check_amount - 1,)
+            )
 
-        if block_id_tuple[0] == 0:
-            previous_block = self.get_block_by_id(block_id_tuple[0])
-        else:
-            previous_block = self.get_block_by_id(block_id_tuple_full[-(check_amount + 1)])
+            row = cursor.fetchone()
+            if row is not None: first_id = row["id"]
 
-        # The tmp block's data is overwritten with db data. Nice little hack :)
-        for id_index, block_id in enumerate(block_id_tuple):
+        # Blocks chained during the check are left for the next one
+        broken_id = self.check_blocks_range(first_id, tip["id"], workers = workers)
 
-            tmp_block.block = self.get_block_by_id(block_id)
+        if first_id == MIN_BLOCK_ID: self.update_checkpoint(broken_id, tip)
 
-            # Checking if the block's previous_hash is correct
-            if block_id != 0: 
-                if previous_block["hash"] != tmp_block.block["previous_hash"]: 
-                    return block_id
+        return broken_id
 
-            # Determining current block's full hash
-            message = tmp_block.det_full_message_to_hash(hex(tmp_block.block["nonce"]))
-            block_hash = "0x" + SHA256(message)
 
-            if block_hash != tmp_block.block["hash"]: return block_id
+    def check_chain_health_from_checkpoint(self, workers: int = 1) -> int:
+        """
+        Same as check_chain_health(-1), but only checks the blocks after the verification checkpoint, 
+        i.e., the last block known to be consistent, along with every block before it.
+        Dirty blocks (see check_dirty_blocks()) before the checkpoint are checked as well.
+        If the checkpoint block no longer has the hash it was verified with, checks every block.
+        Returns the lowest id of an inconsistent block. Returns None if none was found
+        """
 
-            # Updating previous block
-            previous_block = tmp_block.block.copy()
-        
-        return None
+        tip = self.get_tip()
+        if tip is None: return None
+
+        checkpoint_id, checkpoint_hash = self.get_checkpoint()
+
+        first_id = MIN_BLOCK_ID
+        if checkpoint_id is not None:
+            cursor = self._reader().execute("SELECT hash FROM block_chain WHERE id = ?", (checkpoint_id,))
+            row = cursor.fetchone()
+
+            # The block right after the checkpoint is linked to it
+            if row is not None and row["hash"] == checkpoint_hash: first_id = checkpoint_id + 1
+
+        # Blocks before the checkpoint changed since, e.g., by other tools working on the same file
+        broken_id = self.check_dirty_blocks()
+
+        # Blocks after the checkpoint are all checked. The lowest inconsistent one may come before a dirty one
+        if broken_id is None or broken_id >= first_id: broken_id = self.check_blocks_range(first_id, tip["id"], workers = workers)
+
+        self.update_checkpoint(broken_id, tip)
+
+        return broken_id
+
+
+    def check_dirty_blocks(self) -> int:
+        """
+        Checks only the blocks changed or removed since last checked, as recorded by triggers (see _migration_dirty_blocks()), 
+        along with the block right after each of them, whose previous hash links to it.
+        Consistent blocks are cleared from the dirty set, inconsistent ones stay in it.
+        Returns the lowest id of an inconsistent block. Returns None if none was found
+        """
+
+        cursor = self._reader().execute("SELECT block_id FROM dirty_blocks ORDER BY block_id")
+        dirty_ids = [row["block_id"] for row in cursor.fetchall()]
+
+        broken_ids = []
+        clean_ids  = []
+        for dirty_id in dirty_ids:
+            cursor = self._reader().execute(
+                """
+                SELECT *
+                  FROM block_chain
+                 WHERE id >= ?
+                 ORDER BY id
+                 LIMIT 2
+                """,
+                (dirty_id,)
+            )
+
+            # A removed block leaves only the block after it to be checked
+            cursor.row_factory = BlockRecord.from_row
+            blocks = cursor.fetchall()
+            if blocks and blocks[0]["id"] != dirty_id: blocks = blocks[:1]
+
+            dirty_broken_ids = [block["id"] for block in blocks if not self.verify_block_by_id(block)]
+
+            if dirty_broken_ids: broken_ids += dirty_broken_ids
+            else:                clean_ids.append(dirty_id)
+
+        with self.batch():
+            self.cursor.executemany("DELETE FROM dirty_blocks WHERE block_id = ?", [(_id,) for _id in clean_ids])
+
+        return min(broken_ids, default = None)
+
+
+    def claim_pending_transactions(self, limit: int) -> list:
+        """
+        Claims up to limit pending transactions, in order of submission, so that a worker mines them: their status becomes 'mining'.
+        Workers of other connections then do not mine them as well. Returns them as get_pending_transactions() does.
+        A claim ends with the block which settles it (see set_block()), or is handed back by release_pending_transactions()
+        """
+
+        # Reading and claiming in the same transaction, holding the write lock: no other connection claims them in between
+        with self.batch():
+            self.cursor.execute(
+                """
+                SELECT id, from_id, to_id, amount, miner_id
+                  FROM pending_transactions
+                 WHERE status = 'pending'
+                 ORDER BY id
+                 LIMIT ?
+                """,
+                (limit,)
+            )
+
+            pending_transactions = [dict(row) for row in self.cursor.fetchall()]
+
+            self.cursor.executemany(
+                """
+                UPDATE pending_transactions
+                   SET status = 'mining'
+                 WHERE id = ?
+                """,
+                [(pending["id"],) for pending in pending_transactions]
+            )
+
+        return pending_transactions
+
+
+    def delete_block(self, block_id: int) -> None:
+        """
+        Deletes a row from the database, given its id, along with its transactions.
+        If no block with such id was found in the database, does nothing.
+        The balances of the accounts involved are updated in the same transaction
+        """
+
+        self.delete_blocks((block_id,))
+
+
+    def delete_blocks(self, block_ids) -> None:
+        """
+        Deletes many blocks, given their ids, along with their transactions, in a single transaction. See delete_block()
+        """
+
+        block_ids = tuple(block_ids)
+        if not block_ids: return
+
+        with self.batch():
+            account_ids = set().union(*(self._get_block_accounts(block_id) for block_id in block_ids))
+
+            self.cursor.executemany(
+                """
+                DELETE FROM transactions 
+                 WHERE block_id = ?
+                """,
+                [(block_id,) for block_id in block_ids]
+            )
+
+            self.cursor.executemany(
+                """
+                DELETE FROM block_chain 
+                 WHERE id = ?
+                """,
+                [(block_id,) for block_id in block_ids]
+            )
+
+            self._refresh_balances(account_ids)
+            self.rewind_checkpoint(min(block_ids))
+
+
+    def det_account_balance(self, account_id: str) -> float:
+        """
+        Returns the balance of an account, as summed from the chain: its opening balance (INIT_BALANCE), granted on creation,
+        then transfers sent and received, by blocks and by transactions of blocks with many, along with miner rewards.
+        Each part is a lookup on its own index of integer account keys, so that no unrelated row is read
+        """
+
+        cursor = self._reader().execute(ACCOUNT_BALANCE_QUERY, {"account_id": account_id, "opening_balance": self.INIT_BALANCE})
+
+        return cursor.fetchone()[0]
+
+
+    def det_broken_blocks_ids(self, blocks, previous_block: dict = None):
+        """
+        Returns an iterator over the ids of the inconsistent blocks among blocks, an iterator over consecutive blocks in order of id.
+        previous_block: the block right before the first one, if any. See verify_block()
+        The transactions of blocks of many transactions are streamed alongside them
+        """
+
+        # Transactions of blocks before the first one are not needed
+        transactions = self.stream_transactions(MIN_BLOCK_ID if previous_block is None else previous_block["id"])
+
+        # Closing both streams, even if the caller stops at the first broken block
+        try:
+            for block, block_transactions in join_transactions(blocks, transactions):
+                if not self.verify_block(block, previous_block, block_transactions): yield block["id"]
+
+                previous_block = block
+        finally:
+            transactions.close()
+            blocks.close()
+
+
+    def det_next_target(self) -> int:
+        """
+        Returns the target for the next block to be mined.
+        Estimates the hashrate over the latest RETARGET_WINDOW blocks: the hashes each one was expected to take, 
+        given its own target (see det_expected_hashes()), summed, over their summed mining times.
+        The next target is the one expected to take TARGET_MINING_TIME at that hashrate, so each retarget starts over from 
+        what was observed, rather than scaling the latest target again by times measured at other targets.
+        The change from the latest target is clamped to MAX_RETARGET_FACTOR and the result to MAX_TARGET
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT target, mining_time
+              FROM block_chain bc 
+             ORDER BY id DESC
+             LIMIT ?
+            """,
+            (self.RETARGET_WINDOW,)
+        )
+
+        latest_blocks = cursor.fetchall()
+        if not latest_blocks or self.TARGET_MINING_TIME == 0: return self.MAX_TARGET
+
+        latest_target = int(latest_blocks[0]["target"], 16)
+
+        # Blocks mined before mining times were stored do not count
+        timed_blocks = [b for b in latest_blocks if b["mining_time"] is not None]
+        if not timed_blocks: return min(latest_target, self.MAX_TARGET)
+
+        expected_hashes = sum(det_expected_hashes(int(b["target"], 16)) for b in timed_blocks)
+        mining_time     = sum(b["mining_time"] for b in timed_blocks)
+
+        # Only the amount of hashes is a float: the target is then computed as an integer, since a float can not hold 256 bits exactly.
+        # Blocks mined too fast to be timed tighten the target as much as allowed
+        if mining_time > 0:
+            hashrate    = expected_hashes / mining_time
+            next_target = 2**256 // max(round(hashrate * self.TARGET_MINING_TIME), 1) - 1
+        else:
+            next_target = 0
+
+        next_target = min(max(next_target, latest_target // self.MAX_RETARGET_FACTOR), latest_target * self.MAX_RETARGET_FACTOR)
+
+        return min(max(next_target, 1), self.MAX_TARGET)
+
+
+    def get_accounts(self) -> dict:
+        """ Returns a dict containing every account in the "accounts" table """
+
+        cursor = self._reader().execute(
+            """
+            SELECT * 
+            FROM accounts
+            """
+        )
+
+        return dict(cursor.fetchall())
+
+    
+    def get_account_balance(self, account_id: str) -> float:
+        """ 
+        Returns the balance of one specific account
+        Raises LookupError if no account with such id exists in database
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT balance 
+            FROM accounts
+            WHERE id = ?
+            """,
+            (account_id,)
+        )
+
+        try:
+            balance = dict(cursor.fetchone())
+        except TypeError as e:
+            raise LookupError(f"No account with id '{account_id}' exists")
+        
+        return balance["balance"]
+
+
+    def get_accounts_ids_and_usernames(self) -> dict:
+        """ Returns a dict {id:username} containing every account id and username in the "accounts" table """
+
+        cursor = self._reader().execute(
+            """
+            SELECT id, username 
+            FROM accounts
+            """
+        )
+
+        return dict(cursor.fetchall())
+
+
+    def get_all_blocks(self, id_order_asc = True, page_size: int = STREAM_BATCH_SIZE, columns: tuple = None) -> BlockRecord:
+        """ 
+        Returns an iterator over all the blocks in the database, as BlockRecord, in order of id.
+        Queries page_size blocks at a time, each page starting after the last id of the one before (keyset pagination).
+        No cursor is left open between pages, so the database may be written to while iterating.
+        columns: optional tuple of the columns to be queried. "id" is always queried
+        Raises KeyError if a column does not exist
+        """
+
+        if columns is None:
+            selected = "*"
+        else:
+            unknown = set(columns) - self.block_chain_columns - {"id", "previous_id"}
+            if unknown: raise KeyError(f"Unknown block columns {unknown}. They are the following: {self.block_chain_columns}")
+
+            # INSERTING THE COLUMNS DIRECTLY INTO THE STRING IS ONLY OK BECAUSE THEY WERE CHECKED ABOVE
+            selected = ", ".join(("id",) + tuple(c for c in columns if c != "id"))
+
+        if id_order_asc: last_id, comparison, order = MIN_BLOCK_ID, ">", "ASC"
+        else:            last_id, comparison, order = MAX_BLOCK_ID, "<", "DESC"
+
+        while True:
+            cursor = self._reader().execute(
+                """
+                SELECT """ + selected + """
+                  FROM block_chain
+                 WHERE id """ + comparison + """ ?
+                 ORDER BY id """ + order + """
+                 LIMIT ?
+                """,
+                (last_id, page_size)
+            )
+
+            cursor.row_factory = BlockRecord.from_row
+            page = cursor.fetchall()
+
+            yield from page
+
+            if len(page) < page_size: return
+
+            last_id = page[-1]["id"]
+
+
+    def get_block_by_id(self, block_id: int) -> BlockRecord:
+        """
+        Returns all the data of a block, as a BlockRecord
+        Raises LookupError if no block with such id exists in database
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT * 
+            FROM block_chain bc 
+            WHERE id = ?
+            """,
+            (block_id,)
+        )
+
+        cursor.row_factory = BlockRecord.from_row
+        block = cursor.fetchone()
+
+        if block is None: raise LookupError(f"No block with id '{block_id}' exists")
+
+        return block
+
+
+    def get_block_transactions(self, block_id: int) -> list:
+        """
+        Returns the transactions of a block, in order, as dicts with the keys "from_id", "to_id" and "amount".
+        Blocks of a single transfer (no merkle root) have none: their transfer is in the block itself
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT from_id, to_id, amount 
+              FROM transactions
+             WHERE block_id = ?
+             ORDER BY position
+            """,
+            (block_id,)
+        )
+
+        return [dict(row) for row in cursor.fetchall()]
+
+
+    def get_block_count(self) -> int:
+        """ Returns the amount of blocks in the chain. Read from the "chain_metadata" table: constant time """
+
+        return self.get_metadata("block_count")
+
+
+    def get_blocks_ids(self) -> tuple:
+        """
+        Returns a tuple containing the ids of the blocks, in order
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT id 
+            FROM block_chain bc 
+            """
+        )
+
+        return tuple(a[0] for a in cursor.fetchall())
+
+
+    def get_checkpoint(self) -> tuple:
+        """
+        Returns (id, hash) of the verification checkpoint: the last block checked and found consistent, 
+        along with every block before it. Returns (None, None) if there is none
+        """
+
+        return self.get_metadata("checkpoint_id"), self.get_metadata("checkpoint_hash")
+
+
+    def get_metadata(self, key: str) -> Any:
+        """ Returns a value from the "chain_metadata" table. Returns None if the key is not set """
+
+        cursor = self._reader().execute(
+            """
+            SELECT value
+              FROM chain_metadata
+             WHERE key = ?
+            """,
+            (key,)
+        )
+
+        row = cursor.fetchone()
+
+        return None if row is None else row["value"]
+
+
+    def get_next_block_id(self, block_id: int) -> int:
+        """
+        Returns the id of the block right after block_id in the chain, found through the primary key. Returns None if there is none.
+        Blocks are chained in order of id, as verify_block() links them: walking the chain always moves forward
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT id
+              FROM block_chain
+             WHERE id > ?
+             ORDER BY id
+             LIMIT 1
+            """,
+            (block_id,)
+        )
+
+        row = cursor.fetchone()
+
+        return None if row is None else row["id"]
+
+
+    def get_pending_outgoing_amount(self, account_id: str) -> float:
+        """ Returns the sum of every pending transaction sent from an account, including the ones being mined """
+
+        cursor = self._reader().execute(
+            """
+            SELECT COALESCE(SUM(amount), 0) 
+              FROM pending_transactions
+             WHERE from_id = ?
+               AND status IN ('pending', 'mining')
+            """,
+            (account_id,)
+        )
+
+        return cursor.fetchone()[0]
+
+
+    def get_pending_transactions(self) -> list:
+        """
+        Returns every transaction waiting to be mined, in order of submission. Not the ones claimed by a worker (see claim_pending_transactions()).
+        Each one is a dict with the keys "id", "from_id", "to_id", "amount" and "miner_id"
+        """
+
+        cursor = self._reader().execute(
+            """
+            SELECT id, from_id, to_id, amount, miner_id
+              FROM pending_transactions
+             WHERE status = 'pending'
+             ORDER BY id
+            """
+        )
+
+        return [dict(row) for row in cursor.fetchall()]
+
+
+    def get_previous_block_id(self, block_id: int) -> int:
+        """ Returns the id of the block right before block_id in the chain, in order of id, found through the primary key. Returns None if there is none """
+
+        cursor = self._reader().execute(
+            """
+            SELECT id
+              FROM block_chain
+             WHERE id < ?
+             ORDER BY id DESC
+             LIMIT 1
+            """,
+            (block_id,)
+        )
+
+        row = cursor.fetchone()
+
+        return None if row is None else row["id"]
+
+
+    def get_tip(self) -> dict:
+        """ 
+        Returns the id and hash of the last block in the chain. Returns None if the chain is empty.
+        Read from the "chain_metadata" table, kept up to date by triggers: constant time
+        """
+
+        # A single query: the id and hash are read from the same commit, even while blocks are being chained
+        cursor = self._reader().execute("SELECT key, value FROM chain_metadata WHERE key IN ('tip_id', 'tip_hash')")
+        tip = {row["key"]: row["value"] for row in cursor.fetchall()}
+
+        if tip.get("tip_id") is None: return None
+
+        return {"id": tip["tip_id"], "hash": tip["tip_hash"]}
+
+
+    def migrate_schema(self) -> None:
+        """
+        Brings the database schema up to date.
+        Every migration runs only once, tracked by sqlite's 'user_version' pragma.
+        New migrations must be appended to the end of the tuple
+        """
+
+        migrations = (
+            self._migration_block_version,
+            self._migration_block_target,
+            self._migration_pending_transactions,
+            self._migration_transactions,
+            self._migration_chain_metadata,
+            self._migration_dirty_blocks,
+            self._migration_chain_tip,
+            self._migration_previous_id,
+            self._migration_account_indexes,
+            self._migration_balance_ledger,
+            self._migration_compact_storage,
+            self._migration_checkpoint_transactions,
+        )
+
+        # A single transaction, holding the write lock: other connections can not migrate at the same time,
+        # and a failed migration leaves the schema untouched
+        with self.batch():
+            self.cursor.execute("PRAGMA user_version")
+            current_version = self.cursor.fetchone()[0]
+
+            for migration in migrations[current_version:]: migration()
+
+            if current_version < len(migrations):
+                self.cursor.execute(f"PRAGMA user_version = {len(migrations)}")
+
+        # Giving the pages freed by the compact storage back to the file system. Can not run inside a transaction
+        if self._migration_compact_storage in migrations[current_version:]:
+            try:
+                self.conn.execute("VACUUM")
+            except sqlite3.OperationalError:
+                pass  # Another connection is reading: the freed pages are reused instead
+
+
+    def _create_base_schema(self) -> None:
+        """
+        Creates the tables of the very first schema, in an empty database, e.g., one held in memory.
+        Every migration then brings it up to date. See migrate_schema()
+        """
+
+        with self.pool.write_lock:
+            self.pool.writer.execute(
+                """
+                CREATE TABLE accounts(
+                    id TEXT PRIMARY KEY NOT NULL,
+                    username TEXT,
+                    balance REAL NOT NULL,
+                    created_on TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+
+            self.pool.writer.execute(
+                """
+                CREATE TABLE block_chain(
+                    id INTEGER UNIQUE PRIMARY KEY autoincrement NOT NULL,
+                    previous_hash TEXT NOT NULL,
+                    from_id TEXT NOT NULL,
+                    to_id TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    miner_id TEXT NOT NULL,
+                    miner_reward REAL NOT NULL,
+                    nonce INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    FOREIGN KEY(from_id) REFERENCES accounts(id),
+                    FOREIGN KEY(to_id) REFERENCES accounts(id),
+                    FOREIGN KEY(miner_id) REFERENCES accounts(id)
+                )
+                """
+            )
+
+            self.pool.writer.commit()
+
+
+    def _migration_block_version(self) -> None:
+        """
+        Adds the header layout version of each block.
+        Every block mined before this column existed uses layout 1
+        """
+
+        self.cursor.execute(
+            """
+            ALTER TABLE block_chain
+              ADD COLUMN version INTEGER NOT NULL DEFAULT 1
+            """
+        )
+
+
+    def _migration_block_target(self) -> None:
+        """
+        Adds each block's target and how long it took to mine, in seconds.
+        Every block mined before these columns existed used the legacy difficulty of 2 leading hex zeros
+        and has no recorded mining time
+        """
+
+        self.cursor.execute(
+            """
+            ALTER TABLE block_chain
+              ADD COLUMN target TEXT NOT NULL DEFAULT '""" + format_target(LEGACY_TARGET) + """'
+            """
+        )
+
+        self.cursor.execute(
+            """
+            ALTER TABLE block_chain
+              ADD COLUMN mining_time REAL
+            """
+        )
+
+
+    def _migration_pending_transactions(self) -> None:
+        """
+        Adds the queue of transfers waiting to be mined.
+        status: 'pending' until mined (the row is then removed) or 'rejected', if funds were insufficient by then.
+        'mining' while claimed by a worker. See claim_pending_transactions()
+        """
+
+        self.cursor.execute(
+            """
+            CREATE TABLE pending_transactions(
+                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                from_id TEXT NOT NULL,
+                to_id TEXT NOT NULL,
+                amount REAL NOT NULL,
+                miner_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                submitted_on TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(from_id) REFERENCES accounts(id),
+                FOREIGN KEY(to_id) REFERENCES accounts(id),
+                FOREIGN KEY(miner_id) REFERENCES accounts(id)
+            )
+            """
+        )
+
+
+    def _migration_transactions(self) -> None:
+        """
+        Allows blocks of many transactions:
+            - Rebuilds block_chain with a merkle_root column and with from_id, to_id and amount nullable,
+              since blocks of many transactions keep them in the transactions table;
+            - Adds the transactions table.
+        Blocks of a single transfer keep it in the block itself and have no merkle root
+        """
+
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'block_chain'")
+        sequence = self.cursor.fetchone()
+
+        self.cursor.execute(
+            """
+            CREATE TABLE block_chain_new(
+                id INTEGER UNIQUE PRIMARY KEY autoincrement NOT NULL,
+                previous_hash TEXT NOT NULL,
+                from_id TEXT,
+                to_id TEXT,
+                amount REAL,
+                miner_id TEXT NOT NULL,
+                miner_reward REAL NOT NULL,
+                nonce INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                target TEXT NOT NULL DEFAULT '""" + format_target(LEGACY_TARGET) + """',
+                mining_time REAL,
+                merkle_root TEXT,
+                FOREIGN KEY(from_id) REFERENCES accounts(id),
+                FOREIGN KEY(to_id) REFERENCES accounts(id),
+                FOREIGN KEY(miner_id) REFERENCES accounts(id)
+            )
+            """
+        )
+
+        self.cursor.execute(
+            """
+            INSERT INTO block_chain_new (id, previous_hash, from_id, to_id, amount, miner_id, miner_reward, nonce, hash, version, target, mining_time)
+            SELECT id, previous_hash, from_id, to_id, amount, miner_id, miner_reward, nonce, hash, version, target, mining_time
+              FROM block_chain
+            """
+        )
+
+        self.cursor.execute("DROP TABLE block_chain")
+        self.cursor.execute("ALTER TABLE block_chain_new RENAME TO block_chain")
+
+        # Ids of deleted blocks must still never be reused
+        if sequence is not None:
+            self.cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'block_chain'", (sequence[0],))
+
+        self.cursor.execute(
+            """
+            CREATE TABLE transactions(
+                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                block_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                from_id TEXT NOT NULL,
+                to_id TEXT NOT NULL,
+                amount REAL NOT NULL,
+                UNIQUE(block_id, position),
+                FOREIGN KEY(block_id) REFERENCES block_chain(id),
+                FOREIGN KEY(from_id) REFERENCES accounts(id),
+                FOREIGN KEY(to_id) REFERENCES accounts(id)
+            )
+            """
+        )
+
+
+    def _migration_chain_metadata(self) -> None:
+        """
+        Creates the "chain_metadata" table: values about the chain as a whole, by key.
+        E.g., the verification checkpoint. See get_checkpoint()
+        """
+
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chain_metadata (
+                key   TEXT PRIMARY KEY,
+                value
+            )
+            """
+        )
+
+
+    def _migration_dirty_blocks(self) -> None:
+        """
+        Creates the "dirty_blocks" table, along with triggers which record in it the ids of blocks
+        changed or removed after being chained, whichever the connection.
+        Transactions added to a block other than the last one also make it dirty. See check_dirty_blocks()
+        """
+
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dirty_blocks (
+                block_id INTEGER PRIMARY KEY
+            )
+            """
+        )
+
+        triggers = (
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_block_update AFTER UPDATE ON block_chain
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.id), (NEW.id);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_block_delete AFTER DELETE ON block_chain
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.id);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_transaction_insert AFTER INSERT ON transactions
+            WHEN NEW.block_id < (SELECT MAX(id) FROM block_chain)
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (NEW.block_id);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_transaction_update AFTER UPDATE ON transactions
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.block_id), (NEW.block_id);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_transaction_delete AFTER DELETE ON transactions
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.block_id);
+            END
+            """,
+        )
+
+        # One statement at a time: executescript() would commit the migration halfway
+        for trigger in triggers: self.cursor.execute(trigger)
+
+
+    def _migration_chain_tip(self) -> None:
+        """
+        Keeps the id and hash of the last block, along with the amount of blocks, in the "chain_metadata" table.
+        Triggers update them in the same transaction as every insert, delete or change of id/hash in "block_chain", 
+        whichever the connection. See get_tip() and get_block_count()
+        """
+
+        # Statements run by the triggers. The last block is found through the primary key, not by scanning
+        refresh_tip = """
+                INSERT OR REPLACE INTO chain_metadata (key, value)
+                VALUES ('tip_id',   (SELECT id   FROM block_chain ORDER BY id DESC LIMIT 1)),
+                       ('tip_hash', (SELECT hash FROM block_chain ORDER BY id DESC LIMIT 1));
+        """
+
+        triggers = (
+            """
+            CREATE TRIGGER IF NOT EXISTS chain_tip_insert AFTER INSERT ON block_chain
+            BEGIN
+                UPDATE chain_metadata SET value = value + 1 WHERE key = 'block_count';
+            """ + refresh_tip + """
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS chain_tip_delete AFTER DELETE ON block_chain
+            BEGIN
+                UPDATE chain_metadata SET value = value - 1 WHERE key = 'block_count';
+            """ + refresh_tip + """
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS chain_tip_update AFTER UPDATE OF id, hash ON block_chain
+            BEGIN
+            """ + refresh_tip + """
+            END
+            """,
+        )
+
+        self.cursor.execute(
+            """
+            INSERT OR REPLACE INTO chain_metadata (key, value)
+            VALUES ('block_count', (SELECT COUNT(*) FROM block_chain))
+            """
+        )
+
+        self.cursor.execute(refresh_tip)
+
+        for trigger in triggers: self.cursor.execute(trigger)
+
+
+    def _migration_previous_id(self) -> None:
+        """
+        Adds the id of the previous block in the chain to each block, indexed both ways, so that 
+        predecessors and successors are found without scanning the chain. See get_previous_block_id() and get_next_block_id()
+        Triggers keep it up to date: new blocks point to the last one before them, 
+        and the successor of a deleted block points to the deleted block's predecessor
+        """
+
+        self.cursor.execute("ALTER TABLE block_chain ADD COLUMN previous_id INTEGER")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS block_chain_previous_id ON block_chain (previous_id)")
+
+        # Only changes to what is hashed make a block dirty. Not its mining time, nor its previous id
+        self.cursor.execute("DROP TRIGGER IF EXISTS dirty_block_update")
+
+        triggers = (
+            """
+            CREATE TRIGGER IF NOT EXISTS dirty_block_update 
+            AFTER UPDATE OF id, previous_hash, from_id, to_id, amount, miner_id, miner_reward, nonce, hash, version, target, merkle_root ON block_chain
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.id), (NEW.id);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS previous_id_insert AFTER INSERT ON block_chain
+            WHEN NEW.previous_id IS NULL
+            BEGIN
+                UPDATE block_chain 
+                   SET previous_id = (SELECT MAX(id) FROM block_chain WHERE id < NEW.id)
+                 WHERE id = NEW.id;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS previous_id_delete AFTER DELETE ON block_chain
+            BEGIN
+                UPDATE block_chain 
+                   SET previous_id = OLD.previous_id
+                 WHERE previous_id = OLD.id;
+            END
+            """,
+        )
+
+        for trigger in triggers: self.cursor.execute(trigger)
+
+        self.cursor.execute(
+            """
+            UPDATE block_chain
+               SET previous_id = (SELECT MAX(p.id) FROM block_chain p WHERE p.id < block_chain.id)
+            """
+        )
+
+
+    def _migration_account_indexes(self) -> None:
+        """
+        Indexes blocks and transactions by account, along with the amount each one moves.
+        The indexes cover det_account_balance()'s lookups, so they never read the tables themselves
+        """
+
+        indexes = (
+            "CREATE INDEX IF NOT EXISTS block_chain_from_id   ON block_chain (from_id, amount)",
+            "CREATE INDEX IF NOT EXISTS block_chain_to_id     ON block_chain (to_id, amount)",
+            "CREATE INDEX IF NOT EXISTS block_chain_miner_id  ON block_chain (miner_id, miner_reward)",
+            "CREATE INDEX IF NOT EXISTS transactions_from_id  ON transactions (from_id, amount)",
+            "CREATE INDEX IF NOT EXISTS transactions_to_id    ON transactions (to_id, amount)",
+        )
+
+        for index in indexes: self.cursor.execute(index)
+
+
+    def _migration_balance_ledger(self) -> None:
+        """
+        Balances are kept up to date with every block written from now on. See set_block().
+        Sums them from the chain once, so that they start up to date
+        """
+
+        self._write_all_balances()
+
+
+    def _migration_compact_storage(self) -> None:
+        """
+        Moves blocks and transactions to compact tables, "block_store" and "transaction_store":
+            - Hashes, targets and merkle roots are stored as 32 bytes, rather than 66 characters. See encode_hash();
+            - Accounts are referred to by an integer key, interned in the "account_keys" table, rather than by their id.
+        "block_chain" and "transactions" become views over them, with the same columns and values as before,
+        which may also be written to: triggers write what is given into the compact tables.
+        The triggers and indexes of the old tables are recreated on the compact ones
+        """
+
+        # Only needed to copy the old tables. Triggers must not depend on it: other connections do not have it
+        self.conn.create_function("encode_hash", 1, encode_hash, deterministic = True)
+
+        self.cursor.execute(
+            """
+            CREATE TABLE account_keys(
+                key INTEGER PRIMARY KEY NOT NULL,
+                id TEXT UNIQUE NOT NULL
+            )
+            """
+        )
+
+        # Accounts first, in order of creation, so that they get the smallest keys
+        self.cursor.execute(
+            """
+            INSERT OR IGNORE INTO account_keys (id)
+            SELECT id FROM accounts ORDER BY rowid
+            """
+        )
+
+        self.cursor.execute(
+            """
+            INSERT OR IGNORE INTO account_keys (id)
+            SELECT from_id  FROM block_chain  UNION ALL
+            SELECT to_id    FROM block_chain  UNION ALL
+            SELECT miner_id FROM block_chain  UNION ALL
+            SELECT from_id  FROM transactions UNION ALL
+            SELECT to_id    FROM transactions
+            """
+        )
+
+        self.cursor.execute(
+            """
+            CREATE TABLE block_store(
+                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                previous_id INTEGER,
+                previous_hash BLOB NOT NULL,
+                from_key INTEGER,
+                to_key INTEGER,
+                amount REAL,
+                miner_key INTEGER NOT NULL,
+                miner_reward REAL NOT NULL,
+                nonce INTEGER NOT NULL,
+                hash BLOB NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                target BLOB NOT NULL,
+                mining_time REAL,
+                merkle_root BLOB,
+                FOREIGN KEY(from_key) REFERENCES account_keys(key),
+                FOREIGN KEY(to_key) REFERENCES account_keys(key),
+                FOREIGN KEY(miner_key) REFERENCES account_keys(key)
+            )
+            """
+        )
+
+        self.cursor.execute(
+            """
+            CREATE TABLE transaction_store(
+                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                block_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                from_key INTEGER NOT NULL,
+                to_key INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                UNIQUE(block_id, position),
+                FOREIGN KEY(block_id) REFERENCES block_store(id),
+                FOREIGN KEY(from_key) REFERENCES account_keys(key),
+                FOREIGN KEY(to_key) REFERENCES account_keys(key)
+            )
+            """
+        )
+
+        self.cursor.execute(
+            """
+            INSERT INTO block_store (id, previous_id, previous_hash, from_key, to_key, amount, miner_key, miner_reward, nonce, hash, version, target, mining_time, merkle_root)
+            SELECT id, previous_id, encode_hash(previous_hash),
+                   (SELECT key FROM account_keys WHERE id = from_id),
+                   (SELECT key FROM account_keys WHERE id = to_id),
+                   amount,
+                   (SELECT key FROM account_keys WHERE id = miner_id),
+                   miner_reward, nonce, encode_hash(hash), version, encode_hash(target), mining_time, encode_hash(merkle_root)
+              FROM block_chain
+            """
+        )
+
+        self.cursor.execute(
+            """
+            INSERT INTO transaction_store (id, block_id, position, from_key, to_key, amount)
+            SELECT id, block_id, position,
+                   (SELECT key FROM account_keys WHERE id = from_id),
+                   (SELECT key FROM account_keys WHERE id = to_id),
+                   amount
+              FROM transactions
+            """
+        )
+
+        # Ids of deleted blocks and transactions must still never be reused
+        for old, new in (("block_chain", "block_store"), ("transactions", "transaction_store")):
+            self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (old,))
+            sequence = self.cursor.fetchone()
+            if sequence is None: continue
+
+            self.cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (new,))
+
+            # INSERTING THE TABLE NAME DIRECTLY INTO THE STRING IS ONLY OK BECAUSE IT IS NOT USER INPUT
+            self.cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES (?, MAX(?, (SELECT COALESCE(MAX(id), 0) FROM " + new + ")))",
+                (new, sequence[0])
+            )
+
+        # Along with their triggers and indexes
+        self.cursor.execute("DROP TABLE transactions")
+        self.cursor.execute("DROP TABLE block_chain")
+
+        self.cursor.execute(
+            """
+            CREATE VIEW block_chain AS
+            SELECT b.id,
+                   """ + decode_hash_sql("b.previous_hash") + """ AS previous_hash,
+                   f.id AS from_id,
+                   t.id AS to_id,
+                   b.amount,
+                   m.id AS miner_id,
+                   b.miner_reward,
+                   b.nonce,
+                   """ + decode_hash_sql("b.hash") + """ AS hash,
+                   b.version,
+                   """ + decode_hash_sql("b.target") + """ AS target,
+                   b.mining_time,
+                   """ + decode_hash_sql("b.merkle_root") + """ AS merkle_root,
+                   b.previous_id
+              FROM block_store b
+              LEFT JOIN account_keys f ON f.key = b.from_key
+              LEFT JOIN account_keys t ON t.key = b.to_key
+              LEFT JOIN account_keys m ON m.key = b.miner_key
+            """
+        )
+
+        self.cursor.execute(
+            """
+            CREATE VIEW transactions AS
+            SELECT s.id,
+                   s.block_id,
+                   s.position,
+                   f.id AS from_id,
+                   t.id AS to_id,
+                   s.amount
+              FROM transaction_store s
+              LEFT JOIN account_keys f ON f.key = s.from_key
+              LEFT JOIN account_keys t ON t.key = s.to_key
+            """
+        )
+
+        # Writes to the views. Values are stored as they are given: writers encode hashes beforehand (see encode_hash()),
+        # and values left unchanged by an update keep their stored form
+        intern_block_accounts = """
+                INSERT OR IGNORE INTO account_keys (id) VALUES (NEW.from_id), (NEW.to_id), (NEW.miner_id);
+        """
+
+        intern_transaction_accounts = """
+                INSERT OR IGNORE INTO account_keys (id) VALUES (NEW.from_id), (NEW.to_id);
+        """
+
+        # Statement run by the chain tip triggers, which keep the hash as it is read. See _migration_chain_tip()
+        refresh_tip = """
+                INSERT OR REPLACE INTO chain_metadata (key, value)
+                VALUES ('tip_id',   (SELECT id   FROM block_chain ORDER BY id DESC LIMIT 1)),
+                       ('tip_hash', (SELECT hash FROM block_chain ORDER BY id DESC LIMIT 1));
+        """
+
+        triggers = (
+            """
+            CREATE TRIGGER block_chain_insert INSTEAD OF INSERT ON block_chain
+            BEGIN
+            """ + intern_block_accounts + """
+                INSERT INTO block_store (id, previous_id, previous_hash, from_key, to_key, amount, miner_key, miner_reward, nonce, hash, version, target, mining_time, merkle_root)
+                VALUES (
+                    NEW.id, NEW.previous_id, NEW.previous_hash,
+                    (SELECT key FROM account_keys WHERE id = NEW.from_id),
+                    (SELECT key FROM account_keys WHERE id = NEW.to_id),
+                    NEW.amount,
+                    (SELECT key FROM account_keys WHERE id = NEW.miner_id),
+                    NEW.miner_reward, NEW.nonce, NEW.hash, COALESCE(NEW.version, 1),
+                    COALESCE(NEW.target, x'""" + format_target(LEGACY_TARGET)[2:] + """'), NEW.mining_time, NEW.merkle_root
+                );
+            END
+            """,
+            """
+            CREATE TRIGGER block_chain_update INSTEAD OF UPDATE ON block_chain
+            BEGIN
+            """ + intern_block_accounts + """
+                UPDATE block_store
+                   SET id            = NEW.id,
+                       previous_id   = NEW.previous_id,
+                       previous_hash = CASE WHEN NEW.previous_hash IS OLD.previous_hash THEN previous_hash ELSE NEW.previous_hash END,
+                       from_key      = CASE WHEN NEW.from_id IS OLD.from_id THEN from_key ELSE (SELECT key FROM account_keys WHERE id = NEW.from_id) END,
+                       to_key        = CASE WHEN NEW.to_id IS OLD.to_id THEN to_key ELSE (SELECT key FROM account_keys WHERE id = NEW.to_id) END,
+                       amount        = NEW.amount,
+                       miner_key     = CASE WHEN NEW.miner_id IS OLD.miner_id THEN miner_key ELSE (SELECT key FROM account_keys WHERE id = NEW.miner_id) END,
+                       miner_reward  = NEW.miner_reward,
+                       nonce         = NEW.nonce,
+                       hash          = CASE WHEN NEW.hash IS OLD.hash THEN hash ELSE NEW.hash END,
+                       version       = NEW.version,
+                       target        = CASE WHEN NEW.target IS OLD.target THEN target ELSE NEW.target END,
+                       mining_time   = NEW.mining_time,
+                       merkle_root   = CASE WHEN NEW.merkle_root IS OLD.merkle_root THEN merkle_root ELSE NEW.merkle_root END
+                 WHERE id = OLD.id;
+            END
+            """,
+            """
+            CREATE TRIGGER block_chain_delete INSTEAD OF DELETE ON block_chain
+            BEGIN
+                DELETE FROM block_store WHERE id = OLD.id;
+            END
+            """,
+            """
+            CREATE TRIGGER transactions_insert INSTEAD OF INSERT ON transactions
+            BEGIN
+            """ + intern_transaction_accounts + """
+                INSERT INTO transaction_store (id, block_id, position, from_key, to_key, amount)
+                VALUES (
+                    NEW.id, NEW.block_id, NEW.position,
+                    (SELECT key FROM account_keys WHERE id = NEW.from_id),
+                    (SELECT key FROM account_keys WHERE id = NEW.to_id),
+                    NEW.amount
+                );
+            END
+            """,
+            """
+            CREATE TRIGGER transactions_update INSTEAD OF UPDATE ON transactions
+            BEGIN
+            """ + intern_transaction_accounts + """
+                UPDATE transaction_store
+                   SET id       = NEW.id,
+                       block_id = NEW.block_id,
+                       position = NEW.position,
+                       from_key = CASE WHEN NEW.from_id IS OLD.from_id THEN from_key ELSE (SELECT key FROM account_keys WHERE id = NEW.from_id) END,
+                       to_key   = CASE WHEN NEW.to_id IS OLD.to_id THEN to_key ELSE (SELECT key FROM account_keys WHERE id = NEW.to_id) END,
+                       amount   = NEW.amount
+                 WHERE id = OLD.id;
+            END
+            """,
+            """
+            CREATE TRIGGER transactions_delete INSTEAD OF DELETE ON transactions
+            BEGIN
+                DELETE FROM transaction_store WHERE id = OLD.id;
+            END
+            """,
+
+            # See _migration_dirty_blocks() and _migration_previous_id().
+            # The view triggers set every column: only values which actually changed make a block dirty
+            """
+            CREATE TRIGGER dirty_block_update AFTER UPDATE ON block_store
+            WHEN OLD.id            IS NOT NEW.id
+              OR OLD.previous_hash IS NOT NEW.previous_hash
+              OR OLD.from_key      IS NOT NEW.from_key
+              OR OLD.to_key        IS NOT NEW.to_key
+              OR OLD.amount        IS NOT NEW.amount
+              OR OLD.miner_key     IS NOT NEW.miner_key
+              OR OLD.miner_reward  IS NOT NEW.miner_reward
+              OR OLD.nonce         IS NOT NEW.nonce
+              OR OLD.hash          IS NOT NEW.hash
+              OR OLD.version       IS NOT NEW.version
+              OR OLD.target        IS NOT NEW.target
+              OR OLD.merkle_root   IS NOT NEW.merkle_root
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.id), (NEW.id);
+            END
+            """,
+            """
+            CREATE TRIGGER dirty_block_delete AFTER DELETE ON block_store
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.id);
+            END
+            """,
+            """
+            CREATE TRIGGER dirty_transaction_insert AFTER INSERT ON transaction_store
+            WHEN NEW.block_id < (SELECT MAX(id) FROM block_store)
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (NEW.block_id);
+            END
+            """,
+            """
+            CREATE TRIGGER dirty_transaction_update AFTER UPDATE ON transaction_store
+            WHEN OLD.block_id IS NOT NEW.block_id
+              OR OLD.position IS NOT NEW.position
+              OR OLD.from_key IS NOT NEW.from_key
+              OR OLD.to_key   IS NOT NEW.to_key
+              OR OLD.amount   IS NOT NEW.amount
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.block_id), (NEW.block_id);
+            END
+            """,
+            """
+            CREATE TRIGGER dirty_transaction_delete AFTER DELETE ON transaction_store
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (OLD.block_id);
+            END
+            """,
+
+            # See _migration_chain_tip()
+            """
+            CREATE TRIGGER chain_tip_insert AFTER INSERT ON block_store
+            BEGIN
+                UPDATE chain_metadata SET value = value + 1 WHERE key = 'block_count';
+            """ + refresh_tip + """
+            END
+            """,
+            """
+            CREATE TRIGGER chain_tip_delete AFTER DELETE ON block_store
+            BEGIN
+                UPDATE chain_metadata SET value = value - 1 WHERE key = 'block_count';
+            """ + refresh_tip + """
+            END
+            """,
+            """
+            CREATE TRIGGER chain_tip_update AFTER UPDATE ON block_store
+            WHEN OLD.id IS NOT NEW.id OR OLD.hash IS NOT NEW.hash
+            BEGIN
+            """ + refresh_tip + """
+            END
+            """,
+
+            # See _migration_previous_id()
+            """
+            CREATE TRIGGER previous_id_insert AFTER INSERT ON block_store
+            WHEN NEW.previous_id IS NULL
+            BEGIN
+                UPDATE block_store
+                   SET previous_id = (SELECT MAX(id) FROM block_store WHERE id < NEW.id)
+                 WHERE id = NEW.id;
+            END
+            """,
+            """
+            CREATE TRIGGER previous_id_delete AFTER DELETE ON block_store
+            BEGIN
+                UPDATE block_store
+                   SET previous_id = OLD.previous_id
+                 WHERE previous_id = OLD.id;
+            END
+            """,
+        )
+
+        for trigger in triggers: self.cursor.execute(trigger)
+
+        # See _migration_previous_id() and _migration_account_indexes()
+        indexes = (
+            "CREATE INDEX block_store_previous_id     ON block_store (previous_id)",
+            "CREATE INDEX block_store_from_key        ON block_store (from_key, amount)",
+            "CREATE INDEX block_store_to_key          ON block_store (to_key, amount)",
+            "CREATE INDEX block_store_miner_key       ON block_store (miner_key, miner_reward)",
+            "CREATE INDEX transaction_store_from_key  ON transaction_store (from_key, amount)",
+            "CREATE INDEX transaction_store_to_key    ON transaction_store (to_key, amount)",
+        )
+
+        for index in indexes: self.cursor.execute(index)
+
+
+    def _migration_checkpoint_transactions(self) -> None:
+        """
+        Transactions added to a block up to the verification checkpoint also make it dirty, even if it is the last block:
+        checks from the checkpoint would not check it again otherwise. See check_chain_health_from_checkpoint()
+        """
+
+        self.cursor.execute("DROP TRIGGER dirty_transaction_insert")
+
+        self.cursor.execute(
+            """
+            CREATE TRIGGER dirty_transaction_insert AFTER INSERT ON transaction_store
+            WHEN NEW.block_id < (SELECT MAX(id) FROM block_store)
+              OR NEW.block_id <= (SELECT value FROM chain_metadata WHERE key = 'checkpoint_id')
+            BEGIN
+                INSERT OR IGNORE INTO dirty_blocks (block_id) VALUES (NEW.block_id);
+            END
+            """
+        )
+
+
+    def reject_pending_transaction(self, pending_id: int) -> None:
+        """ Marks a pending transaction as rejected, so that it is never mined """
+
+        with self.batch():
+            self.cursor.execute(
+                """
+                UPDATE pending_transactions
+                   SET status = 'rejected'
+                 WHERE id = ?
+                """,
+                (pending_id,)
+            )
+
+
+    def release_pending_transactions(self, pending_ids: tuple = None) -> None:
+        """
+        Hands claimed transactions back to the queue, so that they are mined again. See claim_pending_transactions().
+        pending_ids: ids of the transactions. Every claimed one if None, e.g., those left by a worker which crashed
+        """
+
+        with self.batch():
+            if pending_ids is None:
+                self.cursor.execute("UPDATE pending_transactions SET status = 'pending' WHERE status = 'mining'")
+                return
+
+            self.cursor.executemany(
+                """
+                UPDATE pending_transactions
+                   SET status = 'pending'
+                 WHERE id = ?
+                   AND status = 'mining'
+                """,
+                [(pending_id,) for pending_id in pending_ids]
+            )
+
+
+    def remine_block(self, block_id: int, backend: str = None, workers: int = 1) -> None:
+        """
+        Remines a block, changing the database in place.
+        See Block.mine_block() for the available backends and workers
+        """
+
+        tmp_block = Block.from_stored(self, self.get_block_by_id(block_id))
+        tmp_block.mine_block(backend = backend, workers = workers)
+
+        # Updating database
+        with self.batch():
+            self.cursor.execute(
+                """
+                UPDATE block_chain 
+                   SET hash = ?, 
+                       nonce = ?,
+                       mining_time = ?
+                 WHERE id = ? 
+                """,
+                (encode_hash(tmp_block.block["hash"]), tmp_block.block["nonce"], tmp_block.block["mining_time"], block_id) 
+            )
 
+            self.rewind_checkpoint(block_id)
 
-    def delete_block(self, block_id: int) -> None:
+
+    def remine_blocks(self, block_ids, backend: str = None, workers: int = 1, on_remined = None, on_progress = None) -> None:
         """
-        Deletes a row from the database, given its id.
-        If no block with such id was found in the database, does nothing.
+        Relinks and remines many blocks, in order, as update_previous_hash_by_id() then remine_block() would for each one:
+        a block's previous hash becomes the new hash of the block before it. The first block of the chain keeps its own.
+        Every block is mined first, without holding the write lock, so that other connections may write meanwhile, e.g., to queue transfers.
+        Every previous hash, hash, nonce and mining time is then written in a single transaction.
+        Raises ValueError, writing nothing, if a block was chained or deleted meanwhile: the chain changed under the remined blocks, so the caller should retry.
+        on_remined: optional callable(block id), called once each block is mined
+        See Block.mine_block() for the available backends, workers and on_progress
         """
 
-        self.cursor.execute(
-            """
-            DELETE FROM block_chain 
-             WHERE id = ?
-            """,
-            (block_id, )
-        )
+        # New hash of each block remined so far, by id
+        new_hashes = {}
+        remined    = []
 
-        self.conn.commit()
+        # Compared once the write lock is held. See set_block()
+        tip = self.get_tip()
 
+        for block_id in block_ids:
+            block = self.get_block_by_id(block_id)
 
-    def get_accounts(self) -> dict:
-        """ Returns a dict containing every account in the "accounts" table """
+            # Linked in order of id, as verify_block() checks them
+            previous_id = self.get_previous_block_id(block_id)
+            if previous_id is not None:
+                block["previous_hash"] = new_hashes[previous_id] if previous_id in new_hashes else self.get_block_by_id(previous_id)["hash"]
 
-        self.cursor.execute(
-            """
-            SELECT * 
-            FROM accounts
-            """
-        )
+            Block.from_stored(self, block).mine_block(backend = backend, workers = workers, on_progress = on_progress)
 
-        return dict(self.cursor.fetchall())
+            new_hashes[block_id] = block["hash"]
+            remined.append((encode_hash(block["previous_hash"]), encode_hash(block["hash"]), block["nonce"], block["mining_time"], block_id))
 
-    
-    def get_account_balance(self, account_id: str) -> float:
-        """ 
-        Returns the balance of one specific account
-        Raises LookupError if no account with such id exists in database
-        """
+            if on_remined is not None: on_remined(block_id)
 
-        self.cursor.execute(
-            """
-            SELECT balance 
-            FROM accounts
-            WHERE id = ?
-            """,
-            (account_id,)
-        )
+        if not remined: return
 
-        try:
-            balance = dict(self.cursor.fetchone())
-        except TypeError as e:
-            raise LookupError(f"No account with id '{account_id}' exists")
-        
-        return balance["balance"]
+        with self.batch():
+            if self.get_tip() != tip:
+                raise ValueError("The chain changed while blocks were being remined. Nothing was written, try again")
 
+            self.cursor.executemany(
+                """
+                UPDATE block_chain 
+                   SET previous_hash = ?,
+                       hash = ?, 
+                       nonce = ?,
+                       mining_time = ?
+                 WHERE id = ? 
+                """,
+                remined
+            )
 
-    def get_accounts_ids_and_usernames(self) -> dict:
-        """ Returns a dict {id:username} containing every account id and username in the "accounts" table """
+            self.rewind_checkpoint(min(block_id for *_, block_id in remined))
 
-        self.cursor.execute(
-            """
-            SELECT id, username 
-            FROM accounts
-            """
-        )
 
-        return dict(self.cursor.fetchall())
+    def rewind_checkpoint(self, block_id: int) -> None:
+        """
+        Moves the verification checkpoint to the block right before block_id, if the checkpoint covers it.
+        Called by every write to a block already in the chain, in the same transaction: it does not commit
+        """
+
+        checkpoint_id, _ = self.get_checkpoint()
+        if checkpoint_id is None or checkpoint_id < block_id: return
 
+        self.set_checkpoint_before(block_id)
 
-    def get_all_blocks(self, id_order_asc = True) -> dict:
-        """ 
-        Returns an iterator over all the blocks in the database.
-        Queries one block at a time and in order of id.
+
+    def set_block(self, block: dict, transactions: list = (), pending_ids: tuple = ()) -> None:
+        """
+        Writes a block into the database, along with its transactions, if it holds many.
+        In the same transaction, holding the write lock from the start:
+            - The balances of the accounts involved are updated. See _apply_block_balances();
+            - The pending transactions with ids in pending_ids are removed.
+        Raises ValueError, writing nothing, if:
+            - The block does not build on the current tip: its previous hash is not the tip's hash (zeros, for the first block).
+              E.g., another connection chained a block while this one was mined;
+            - Any of the pending transactions is no longer queued, e.g., another connection settled it already;
+            - A sender can not afford its transfer
         """
 
-        blocks_id_list = self.get_blocks_ids()
+        # Checking the block keys
+        if set(block.keys()) != self.block_chain_columns:
+            raise KeyError(f"Provided block does not contain the correct keys. They are the following: {self.block_chain_columns}")
+
+        # Other connections can not change balances between the funds check and the commit
+        with self.batch():
+            tip = self.get_tip()
 
-        # Reversing the ids order
-        if not id_order_asc: blocks_id_list = blocks_id_list[::-1]
+            tip_hash = GENESIS_PREVIOUS_HASH if tip is None else tip["hash"]
+            if block["previous_hash"] != tip_hash:
+                raise ValueError(f"The block does not build on the chain's tip. Previous hash: {block['previous_hash']}. Tip's hash: {tip_hash}")
 
-        # Queries one block at a time. Less RAM usage
-        for i in blocks_id_list:
+            # The first block of an empty chain is the genesis block
+            if tip is None: block = {"id": GENESIS_BLOCK_ID, **block}
+
+            # INSERTING THE VARIABLES DIRECTLY INTO THE STRING IS ONLY OK BECAUSE THIS DOES NOT CONTAIN USER INPUT
+            # This will not be susceptible to sql injection attacks.
+            # It is done here because "Parameter markers can be used only for values", as explained in https://stackoverflow.com/questions/13880786/python-sqlite3-string-variable-in-execute
             self.cursor.execute(
                 """
-                SELECT * 
-                FROM block_chain bc 
-                WHERE id = ?
+                INSERT INTO block_chain """ + str(tuple(block.keys())) + """
+                VALUES (""" + ", ".join("?" * len(block)) + """);
                 """,
-                (i,)
+                [encode_hash(value) if key in HASH_COLUMNS else value for key, value in block.items()]
             )
 
-            yield dict(self.cursor.fetchone())
+            # Written through a view: lastrowid is not set. The block just written is the tip
+            block_id = self.get_tip()["id"]
 
+            self.cursor.executemany(
+                """
+                INSERT INTO transactions (block_id, position, from_id, to_id, amount)
+                VALUES (?, ?, ?, ?, ?);
+                """,
+                [(block_id, position, t["from_id"], t["to_id"], t["amount"]) for position, t in enumerate(transactions)]
+            )
 
-    def get_block_by_id(self, block_id: int) -> dict:
-        """ Returns a dictionary containing all the data of a block """
+            self._apply_block_balances(block, transactions)
 
-        self.cursor.execute(
-            """
-            SELECT * 
-            FROM block_chain bc 
-            WHERE id = ?
-            """,
-            (block_id,)
-        )
+            self.cursor.executemany(
+                """
+                DELETE FROM pending_transactions
+                 WHERE id = ?
+                """,
+                [(pending_id,) for pending_id in pending_ids]
+            )
 
-        return dict(self.cursor.fetchone())
+            # Settling a transaction twice would move its amount twice
+            if self.cursor.rowcount < len(pending_ids):
+                raise ValueError(f"Some of the pending transactions {tuple(pending_ids)} are no longer queued")
 
 
-    def get_blocks_ids(self) -> tuple:
+    def set_blocks(self, blocks) -> None:
         """
-        Returns a tuple containing the ids of the blocks, in order
+        Writes many blocks, in order, in a single transaction, e.g., when importing a chain.
+        Each block is written by set_block(), in turn: its id and its senders' funds depend on the blocks before it.
+        blocks: iterable of (block, transactions) pairs. See set_block()
+        Raises ValueError, writing none of them, if a sender can not afford its transfer
         """
 
-        self.cursor.execute(
-            """
-            SELECT id 
-            FROM block_chain bc 
-            """
-        )
-
-        return tuple(a[0] for a in self.cursor.fetchall())
+        with self.batch():
+            for block, transactions in blocks: self.set_block(block, transactions)
 
 
-    def remine_block(self, block_id: int) -> None:
-        """
-        Remines a block, changing the database in place
-        """
+    def set_checkpoint(self, block_id: int, block_hash: str) -> None:
+        """ Sets the verification checkpoint. See get_checkpoint(). Does not commit """
 
-        dummy_data = {
-            "from_id":  None,
-            "to_id":    None,
-            "amount":   None,
-            "miner_id": None
-        }
+        self.set_metadata("checkpoint_id", block_id)
+        self.set_metadata("checkpoint_hash", block_hash)
 
-        tmp_block = Block(self, dummy_data)
 
-        tmp_block.block = self.get_block_by_id(block_id)
-        tmp_block.mine_block()
+    def set_checkpoint_before(self, block_id: int) -> None:
+        """ Sets the verification checkpoint to the block right before block_id, or to none if there is no such block. Does not commit """
 
-        # Updating database
         self.cursor.execute(
             """
-            UPDATE block_chain 
-               SET hash = ?, 
-                   nonce = ?
-             WHERE id = ? 
+            SELECT id, hash
+              FROM block_chain
+             WHERE id < ?
+             ORDER BY id DESC
+             LIMIT 1
             """,
-            (tmp_block.block["hash"], tmp_block.block["nonce"], block_id) 
+            (block_id,)
         )
 
-        self.conn.commit()
+        previous_block = self.cursor.fetchone()
 
+        if previous_block is None: self.set_checkpoint(None, None)
+        else:                      self.set_checkpoint(previous_block["id"], previous_block["hash"])
 
-    def set_block(self, block: dict) -> None:
-        """
-        Writes a block into the database.
-        """
 
-        # Checking the block keys
-        if set(block.keys()) != self.block_chain_columns:
-            raise KeyError(f"Provided block does not contain the correct keys. They are the following: {self.block_chain_columns}")
+    def set_metadata(self, key: str, value: Any) -> None:
+        """ Sets a value in the "chain_metadata" table. Does not commit, so that it may share a transaction with other writes """
 
-        # INSERTING THE VARIABLES DIRECTLY INTO THE STRING IS ONLY OK BECAUSE THIS DOES NOT CONTAIN USER INPUT
-        # This will not be susceptible to sql injection attacks.
-        # It is done here because "Parameter markers can be used only for values", as explained in https://stackoverflow.com/questions/13880786/python-sqlite3-string-variable-in-execute
         self.cursor.execute(
             """
-            INSERT INTO block_chain """ + str(tuple(block.keys())) + """
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            INSERT OR REPLACE INTO chain_metadata (key, value)
+            VALUES (?, ?)
             """,
-            list(block.values())
+            (key, value)
         )
 
-        self.conn.commit()
-
 
     def set_new_user(self, data: dict) -> None:
         """
@@ -313,15 +2282,46 @@ class BlockChain():
             raise AssertionError("Required key 'id' missing")
 
 
-        self.cursor.execute(
-            """
-            INSERT INTO accounts (id, username, balance)
-            VALUES (?, ?, ?);
-            """,
-            (args["id"], args["username"], args["balance"])
-        )
+        with self.batch():
+            self.cursor.execute(
+                """
+                INSERT INTO accounts (id, username, balance)
+                VALUES (?, ?, ?);
+                """,
+                (args["id"], args["username"], args["balance"])
+            )
+
+
+    def set_pending_transaction(self, block_data: dict) -> int:
+        """
+        Writes a transfer into the queue of pending transactions, to be mined in the background.
+        block_data must have as keys "from_id", "to_id", "amount" and "miner_id".
+        Returns the id of the pending transaction.
+        Raises ValueError if from_id can not afford it, counting its other pending transactions
+        """
 
-        self.conn.commit()
+        # Holding the write lock from the funds check to the commit: two sends can not both spend the same funds
+        with self.batch():
+            available = self.get_account_balance(block_data["from_id"]) - self.get_pending_outgoing_amount(block_data["from_id"])
+
+            if available <= block_data["amount"]:
+                raise ValueError(
+                    f"""
+                    Insufficient funds on account {block_data["from_id"]}.
+                    Available cash, minus pending transactions: {available}.
+                    Required cash:  {block_data["amount"]}.
+                    """
+                )
+
+            self.cursor.execute(
+                """
+                INSERT INTO pending_transactions (from_id, to_id, amount, miner_id)
+                VALUES (?, ?, ?, ?);
+                """,
+                (block_data["from_id"], block_data["to_id"], block_data["amount"], block_data["miner_id"])
+            )
+
+        return self.cursor.lastrowid
 
 
     def set_user_balance(self, account_id: str, balance: float) -> None:    
@@ -329,107 +2329,214 @@ class BlockChain():
         Updates a user's account's balance
         """
 
-        self.cursor.execute(
+        self.set_user_balances({account_id: balance})
+
+
+    def set_user_balances(self, balances: dict) -> None:
+        """
+        Updates many accounts' balances in a single transaction.
+        balances: {account id: balance}
+        """
+
+        with self.batch():
+            self.cursor.executemany(
+                """
+                UPDATE accounts
+                SET balance = ?
+                WHERE id = ?
+                """,
+                [(balance, account_id) for account_id, balance in balances.items()]
+            )
+
+
+    def stream_blocks(self, first_id: int = MIN_BLOCK_ID, last_id: int = MAX_BLOCK_ID):
+        """
+        Returns an iterator over the blocks with ids in [first_id, last_id], in order of id, as BlockRecord.
+        Reads them through a single query, STREAM_BATCH_SIZE rows at a time
+        """
+
+        return stream_query(
+            self._reader(),
             """
-            UPDATE accounts
-            SET balance = ?
-            WHERE id = ?
+            SELECT *
+              FROM block_chain
+             WHERE id BETWEEN ? AND ?
+             ORDER BY id
             """,
-            (balance, account_id)
+            (first_id, last_id),
+            row_factory = BlockRecord.from_row
         )
 
-        self.conn.commit()
 
+    def stream_transactions(self, first_id: int = MIN_BLOCK_ID, last_id: int = MAX_BLOCK_ID):
+        """
+        Returns an iterator over (block id, list of transactions) for the blocks of many transactions
+        with ids in [first_id, last_id], in order of block id. See get_block_transactions()
+        """
 
-    def update_all_balances(self) -> None:
-        """ Update every user's balances """
+        rows = stream_query(
+            self._reader(),
+            """
+            SELECT block_id, from_id, to_id, amount
+              FROM transactions
+             WHERE block_id BETWEEN ? AND ?
+             ORDER BY block_id, position
+            """,
+            (first_id, last_id)
+        )
 
-        user_balances = {id: 0 for id in self.get_accounts_ids_and_usernames().keys()}
+        for block_id, block_rows in itertools.groupby(rows, key = lambda row: row["block_id"]):
+            yield block_id, list(block_rows)
 
-        # Summing up every user's transactions
-        for block in self.get_all_blocks():
-            user_balances[block["from_id"]]  -= block["amount"]
-            user_balances[block["to_id"]]    += block["amount"]
-            user_balances[block["miner_id"]] += block["miner_reward"]
 
-        # Writing to database
-        for account_id, balance in user_balances.items():
-            self.set_user_balance(account_id, balance)
+    def update_all_balances(self) -> None:
+        """
+        Update every user's balances.
+        Sums every account's opening balance (INIT_BALANCE) and transactions in a single aggregate query and writes every balance in a single transaction
+        """
+
+        with self.batch():
+            self._write_all_balances()
 
 
-    def update_previous_hash_by_id(self, block_id: int, blocks_ids_tuple: tuple = None) -> None:
+    def update_previous_hash_by_id(self, block_id: int) -> None:
         """
         Updates the 'previous_hash' field of a block with the "hash" field of the block before it, given an id.
-
-        If this function is called multiple times in a row, a simple optimization is to pre calculate 'blocks_ids_tuple' by calling self.get_blocks_ids() and pass it as an argument to this function.
-
-        Otherwise, such method will be called every single time this one is called.
+        The block before it is the one with the closest smaller id, found through the primary key, as verify_block() links them.
+        The first block has no block before it, so any previous_hash stands: it is left untouched
         """
 
-        # Block 0 is special. 
-        # It it the always first block, so any value stands
-        if block_id == 0: return 
+        self.update_previous_hashes_by_ids((block_id,))
 
-        # Getting all the blocks' ids - May be provided as function argument
-        if blocks_ids_tuple is None: blocks_ids = self.get_blocks_ids()
 
-        previous_block_id = blocks_ids_tuple[blocks_ids_tuple.index(block_id)-1]
+    def update_previous_hashes_by_ids(self, block_ids) -> None:
+        """
+        Updates the 'previous_hash' field of many blocks in a single transaction. See update_previous_hash_by_id().
+        Each block reads the hash of the block before it as currently stored: remining in between is up to the caller
+        """
 
-        self.cursor.execute(
-            """
-            UPDATE block_chain 
-               SET previous_hash = ?
-             WHERE id = ?
-            """,
-            (self.get_block_by_id(previous_block_id)["hash"], block_id)
-        )
+        block_ids = tuple(block_ids)
+        if not block_ids: return
 
+        # On the compact table: the hash is copied as it is stored
+        with self.batch():
+            self.cursor.executemany(
+                """
+                UPDATE block_store 
+                   SET previous_hash = (SELECT p.hash FROM block_store p WHERE p.id < block_store.id ORDER BY p.id DESC LIMIT 1)
+                 WHERE id = ?
+                   AND id > (SELECT MIN(id) FROM block_store)
+                """,
+                [(block_id,) for block_id in block_ids]
+            )
 
-    def update_user_balance(self, account_id: str) -> None:
-        """ Updates a user's balance by looping over every transaction """
+            self.rewind_checkpoint(min(block_ids))
 
-        # Getting relevant transactions/blocks
-        self.cursor.execute(
-            """
-            SELECT from_id, to_id, amount, miner_id, miner_reward
-              FROM block_chain bc 
-             WHERE from_id = ?
-                OR to_id = ?
-                OR miner_id = ?
-            """,
-            (account_id, account_id, account_id)
-        )
 
-        transactions = [dict(item) for item in self.cursor.fetchall()]
-        
-        # Summing the transactions
-        account_balance = 0
-        for t in transactions:
-            if   account_id == t["from_id"]:  account_balance -= t["amount"]
-            elif account_id == t["to_id"]:    account_balance += t["amount"]
-            elif account_id == t["miner_id"]: account_balance += t["miner_reward"]
+    def update_user_balance(self, account_id: str) -> None:
+        """ Updates a user's balance by summing its opening balance and every transaction of the account. See det_account_balance() """
 
-        self.set_user_balance(account_id, account_balance)
+        self.set_user_balance(account_id, self.det_account_balance(account_id))
 
 
     def update_any_column_any_block(self, block_id: int, column: str, value: Any) -> None:
         """
         Updates any column of any block with value.
+        The id and the previous id are derived from the order of the chain, and cannot be updated: raises KeyError.
+        The balances of the accounts involved, before and after, are updated in the same transaction
         """
-        
-        # INSERTING THE VARIABLES DIRECTLY INTO THE STRING IS ONLY OK BECAUSE THIS DOES NOT CONTAIN USER INPUT
-        # This will not be susceptible to sql injection attacks.
-        # It is done here because "Parameter markers can be used only for values", as explained in https://stackoverflow.com/questions/13880786/python-sqlite3-string-variable-in-execute
-        self.cursor.execute(
+
+        if column not in self.block_chain_columns:
+            raise KeyError(f"Unknown or derived block column '{column}'. They are the following: {self.block_chain_columns}")
+
+        with self.batch():
+            account_ids = self._get_block_accounts(block_id)
+
+            # INSERTING THE VARIABLES DIRECTLY INTO THE STRING IS ONLY OK BECAUSE THIS DOES NOT CONTAIN USER INPUT
+            # This will not be susceptible to sql injection attacks.
+            # It is done here because "Parameter markers can be used only for values", as explained in https://stackoverflow.com/questions/13880786/python-sqlite3-string-variable-in-execute
+            self.cursor.execute(
+                """
+                UPDATE block_chain
+                   SET """ + column + """ = ?
+                 WHERE id = ?
+                """,
+                (encode_hash(value) if column in HASH_COLUMNS else value, block_id)
+            )
+
+            self._refresh_balances(account_ids | self._get_block_accounts(block_id))
+            self.rewind_checkpoint(block_id)
+
+
+    def update_checkpoint(self, broken_id: int, tip: dict) -> None:
+        """
+        Moves the verification checkpoint after a check which covered every block after it, up to tip (see get_tip()).
+        broken_id: the lowest inconsistent block found, if any. The checkpoint is then the block right before it
+        """
+
+        with self.batch():
+            if broken_id is None: self.set_checkpoint(tip["id"], tip["hash"])
+            else:                 self.set_checkpoint_before(broken_id)
+
+            # Every block up to the checkpoint has just been checked
+            checkpoint_id, _ = self.get_checkpoint()
+            if checkpoint_id is not None:
+                self.cursor.execute("DELETE FROM dirty_blocks WHERE block_id <= ?", (checkpoint_id,))
+
+
+    def verify_block(self, block, previous_block, transactions: list = ()) -> bool:
+        """
+        Returns True if a block (dict or BlockRecord) is consistent:
+            - Its previous_hash is previous_block's hash. Not checked for block 0, the first ever.
+              A block other than 0 without previous block is inconsistent;
+            - Blocks of many transactions: its merkle root is the one of transactions;
+            - Its hash is the one of its header;
+            - Its hash meets its target, which can not be easier than the maximum
+        """
+
+        # Checking if the block's previous_hash is correct
+        if block["id"] != GENESIS_BLOCK_ID:
+            if previous_block is None or previous_block["hash"] != block["previous_hash"]: return False
+
+        # Blocks of many transactions must commit to exactly the ones stored
+        if block["merkle_root"] is not None:
+            if det_merkle_root(transactions, self.hash_backend) != block["merkle_root"]: return False
+
+        # Determining the block's full hash, given the block's header layout
+        try:
+            block_hash = Block.from_stored(self, block).det_hash(block["nonce"])
+        except (ValueError, TypeError, struct.error):
+            return False
+
+        if block_hash != block["hash"]: return False
+
+        # The hash must meet the block's target, which can not be easier than the maximum
+        try:
+            target = int(block["target"], 16)
+        except (TypeError, ValueError):
+            return False
+
+        return target <= self.MAX_TARGET and int(block_hash, 16) <= target
+
+
+    def verify_block_by_id(self, block) -> bool:
+        """ Same as verify_block(), for a single block (dict or BlockRecord): its previous block and transactions are queried """
+
+        cursor = self._reader().execute(
             """
-            UPDATE block_chain
-               SET """ + column + """ = ?
-             WHERE id = ?
+            SELECT *
+              FROM block_chain
+             WHERE id < ?
+             ORDER BY id DESC
+             LIMIT 1
             """,
-            (value, block_id)
+            (block["id"],)
         )
 
-        self.conn.commit()
+        cursor.row_factory = BlockRecord.from_row
+        previous_block = cursor.fetchone()
+
+        return self.verify_block(block, previous_block, self.get_block_transactions(block["id"]))
 
 
 class Block():
@@ -437,14 +2544,19 @@ class Block():
         """
         Creates a Block object
         Database connection parameter necessary in order to determine the previous block's hash
+        block_info must have as keys either:
+            - "from_id", "to_id", "amount", "miner_id": a block of a single transfer;
+            - "transactions", "miner_id": a block of many transactions, each a dict with the keys
+              "from_id", "to_id" and "amount", committed to by a merkle root.
         """
 
         # Variables
         self.block_has_been_mined = False
 
         # Constants
-        self.difficulty: int      = 2
         self.miner_reward: float  = 10000.0
+        self.header_version: int  = 3           # Blocks of a single transfer
+        self.header_version_many: int = 4       # Blocks of many transactions
         self.clear_command: str   = "cls" if os.name == "nt" else "clear"
 
         required_keys = (
@@ -453,39 +2565,84 @@ class Block():
             "amount",
             "miner_id"
         )
+
+        required_keys_many = (
+            "transactions",
+            "miner_id"
+        )
         
-        if tuple(block_info.keys()) != required_keys:
+        if tuple(block_info.keys()) not in (required_keys, required_keys_many):
             raise KeyError(
                 f"""
                 Keys from provided dictionary are incorrect
-                Required keys: {required_keys}
+                Required keys: {required_keys} or {required_keys_many}
                 """
                 )
 
+        # Same SHA256 implementation as the chain's
+        self.hash_backend: HashBackend = db.hash_backend
+
         # Setting up the block
-        self.block = block_info.copy() 
+        if "transactions" in block_info:
+            self.transactions = [t.copy() for t in block_info["transactions"]]
+
+            self.block = {
+                "from_id":     None,
+                "to_id":       None,
+                "amount":      None,
+                "miner_id":    block_info["miner_id"],
+                "merkle_root": det_merkle_root(self.transactions, self.hash_backend),
+                "version":     self.header_version_many
+            }
+        else:
+            self.transactions = []
+
+            self.block = block_info.copy() 
+            self.block["merkle_root"] = None
+            self.block["version"]     = self.header_version
+
         self.block["miner_reward"] = self.miner_reward
+        self.block["target"]       = format_target(db.det_next_target())
+
+        tip = db.get_tip()
+        self.block["previous_hash"] = GENESIS_PREVIOUS_HASH if tip is None else tip["hash"]
+
+
+    @classmethod
+    def from_stored(cls, db: BlockChain, block) -> "Block":
+        """
+        Wraps a block already in the database (dict or BlockRecord), e.g., in order to rehash it.
+        Unlike __init__(), makes no queries
+        """
 
-        for b in db.get_all_blocks(id_order_asc = False):
-            self.block["previous_hash"] = b["hash"]
-            break
+        stored = cls.__new__(cls)
+        stored.block_has_been_mined = True
+        stored.hash_backend = db.hash_backend
+        stored.transactions = []
+        stored.block = block
 
+        return stored
 
-    def chain_block(self, db: BlockChain) -> None:
+
+    def chain_block(self, db: BlockChain, pending_ids: tuple = ()) -> None:
         """ 
-        Adds a block to the chain
+        Adds a block to the chain, along with its transactions.
+        The balances of the accounts involved are updated, and the pending transactions it settles (pending_ids) 
+        are removed from the queue, in the same commit.
         Raises KeyError if block has not been mined yet
+        Raises ValueError if a sender can not afford its transfer. See BlockChain.set_block()
         """
 
         # The block needs to have been mined
         if not self.block_has_been_mined:
             raise KeyError("Block has not been mined")
 
-        db.set_block(self.block)
+        db.set_block(self.block, transactions = self.transactions, pending_ids = pending_ids)
       
 
     def det_full_message_to_hash(self, nonce: str, base_message = None) -> str:
         """
+        Header layout 1 only.
         Returns the full message to be hashed, which, in turn, determines the block's hash.
         The optional base_message parameter is used for block mining, when
         only the nonce changes every iteration.
@@ -497,6 +2654,53 @@ class Block():
         return nonce + base_message
 
 
+    def det_hash(self, nonce: int) -> str:
+        """
+        Returns the block's hash ("0x..."), given a nonce.
+        The layout of the hashed message is chosen by the block's "version" field. See det_header_prefix()
+        Raises ValueError if the version is unknown or the block's fields can not be packed
+        """
+
+        if self.block["version"] == 1:
+            return "0x" + self.hash_backend.hexdigest(self.det_full_message_to_hash(hex(nonce)))
+
+        hasher = self.hash_backend.new(self.det_header_prefix())
+        hasher.update(struct.pack(HEADER_NONCE_FORMAT, nonce))
+
+        return "0x" + hasher.hexdigest()
+
+
+    def det_header_prefix(self) -> bytes:
+        """
+        Header layouts 2 and above.
+        Returns the canonical binary packing of every header field, except the nonce.
+        The nonce is appended after it in a fixed width, so that miners may
+        absorb this prefix once and only hash the final chunk for every nonce.
+            - Layout 2: version, previous_hash, from_id, to_id, amount, miner_id, miner_reward
+            - Layout 3: layout 2, followed by the target (32 bytes), which is then committed to by the hash
+            - Layout 4: version, previous_hash, merkle_root, miner_id, miner_reward, target.
+                        For blocks of many transactions, which are committed to by the merkle root
+        Raises ValueError if the version is unknown or previous_hash/merkle_root/target are not hex
+        """
+
+        version = self.block["version"]
+        if version not in HEADER_VERSIONS[1:]:
+            raise ValueError(f"Unknown block header version {version}")
+
+        prefix = struct.pack(">I", version) + bytes.fromhex(self.block["previous_hash"][2:])
+
+        if version >= 4:
+            prefix += bytes.fromhex(self.block["merkle_root"][2:])
+        else:
+            prefix += pack_transaction(self.block)
+
+        prefix += pack_str(self.block["miner_id"]) + struct.pack(">d", self.block["miner_reward"])
+
+        if version >= 3: prefix += bytes.fromhex(self.block["target"][2:])
+
+        return prefix
+
+
     def det_partial_string_to_hash(self) -> str:
         """
         Returns a partial string containing the block's data
@@ -510,44 +2714,138 @@ class Block():
                 str(self.block["miner_reward"])
  
 
-    def mine_block(self, print_steps = False) -> None:        
+    def det_mining_message(self):
+        """
+        Returns the part of the hashed message which does not change with the nonce.
+        Layout 1: the partial string. Other layouts: the header prefix
+        """
+
+        if self.block["version"] == 1: return self.det_partial_string_to_hash()
+
+        return self.det_header_prefix()
+
+
+    def mine_block(self, print_steps = False, backend: str = None, workers: int = 1, on_progress = None) -> None:        
         """ 
         Calculates and sets the hash of a block.
         This method determines the order of bytes in hash input.
+        backend: name of the hash backend to mine with. Defaults to the block's (i.e., the chain's) backend.
+            Backends with a lane parallel search (e.g. "numpy") try batches of nonces at once.
+            Others try one nonce per iteration.
+            Header layout 1 blocks are always mined one nonce at a time, since their nonce is not a fixed width suffix.
+        workers: if > 1, the nonce space is split among this many processes. 
+            The first one to find a valid nonce cancels the others.
+        on_progress: optional callable(Mining.MiningStats), called periodically while mining.
+            If print_steps, defaults to a throttled progress line.
+        The hash must be <= the block's "target".
+        Sets self.mining_stats: nonces tried, elapsed time and hashrate (all workers combined)
+        Raises LookupError if the backend is unknown
         """
 
-        # Full message
-        base_message = self.det_partial_string_to_hash()
-        nonce = 0
-        compare = "0" * self.difficulty
+        hash_backend = self.hash_backend if backend is None else get_backend(backend)
+        message = self.det_mining_message()
+        target  = int(self.block["target"], 16)
 
-        if print_steps: os.system(self.clear_command)
+        if print_steps: 
+            os.system(self.clear_command)
+            if on_progress is None: on_progress = print_progress
 
         # Mining block
-        while True:
-            if print_steps: 
-                print(f"Trying nonce {nonce}", end = "\r")
-
-            message = self.det_full_message_to_hash(hex(nonce), base_message = base_message)
-            this_hash = SHA256(message)
-            
-            if this_hash[0 : self.difficulty] != compare:                
-                nonce += 1
-            else:
-                if print_steps: 
-                    os.system(self.clear_command)
-                    print(f"Block MINED. Adding {self.block['miner_reward']} to {self.block['miner_id']} as miner reward")
-                    print(f"Nonce: {nonce}")
-                    print(f"Hash: {this_hash}")
-                    print("")
-                break
+        self.mining_stats = MiningStats(target)
+
+        if workers > 1:
+            if print_steps: print(f"Mining with {workers} processes...")
+            nonce, this_hash, _ = mine_parallel(self.block["version"], message, target, hash_backend.name, workers, stats = self.mining_stats, on_progress = on_progress)
+        else:
+            nonce, this_hash, _ = search_with_stats(self.block["version"], message, target, hash_backend, stats = self.mining_stats, on_progress = on_progress)
+
+        if print_steps: 
+            os.system(self.clear_command)
+            print(f"Block MINED. Adding {self.block['miner_reward']} to {self.block['miner_id']} as miner reward")
+            print(f"Nonce: {nonce}")
+            print(f"Hash: {this_hash}")
+            print(f"Hashrate: {self.mining_stats.hashrate:.0f} H/s ({self.mining_stats.nonces_tried} hashes in {self.mining_stats.elapsed:.2f} s)")
+            print("")
 
         # Writing info into block
-        self.block["hash"]  = "0x" + this_hash
-        self.block["nonce"] = nonce
+        self.block["hash"]        = "0x" + this_hash
+        self.block["nonce"]       = nonce
+        self.block["mining_time"] = self.mining_stats.elapsed
 
         self.block_has_been_mined = True
                
 
+
+def merkle_check(hash_backend: str = None) -> None:
+    """
+    Chains two blocks of 3 transactions in a database held in memory, then appends a copy of the last block's
+    last transaction, the way an odd merkle level is padded.
+    Raises AssertionError unless the merkle root changes and both health checks find the block inconsistent
+    """
+
+    db = BlockChain(MEMORY_DB_PATH, hash_backend = hash_backend)
+    for _id in ("0xa", "0xb", "0xm"): db.set_new_user({"id": _id})
+
+    transactions = [{"from_id": "0xa", "to_id": "0xb", "amount": amount} for amount in (1.0, 2.0, 3.0)]
+
+    if det_merkle_root(transactions, db.hash_backend) == det_merkle_root(transactions + transactions[-1:], db.hash_backend):
+        raise AssertionError("The merkle root does not commit to the amount of transactions")
+
+    for _ in range(2):
+        block = Block(db, {"transactions": transactions, "miner_id": "0xm"})
+        block.mine_block()
+        block.chain_block(db)
+
+    # Moves the checkpoint to the last block
+    tip_id = db.get_tip()["id"]
+    if db.check_chain_health(-1) is not None: raise AssertionError("A healthy chain was found inconsistent")
+
+    with db.batch():
+        db.cursor.execute(
+            "INSERT INTO transactions (block_id, position, from_id, to_id, amount) VALUES (?, ?, ?, ?, ?)",
+            (tip_id, len(transactions), "0xa", "0xb", transactions[-1]["amount"])
+        )
+
+    if db.check_chain_health_from_checkpoint() != tip_id: raise AssertionError("A duplicated transaction was not found from the checkpoint")
+    if db.check_chain_health(-1) != tip_id:               raise AssertionError("A duplicated transaction was not found")
+
+
+def account_balance_plan_check(db: BlockChain = None) -> None:
+    """
+    Runs EXPLAIN QUERY PLAN on det_account_balance()'s query, by default in a database held in memory, migrated from scratch.
+    Raises AssertionError unless every branch searches an index covering the columns it reads: no table is scanned,
+    nor read beyond its index, and each kind of transfer is looked up on its own account index
+    """
+
+    if db is None: db = BlockChain(MEMORY_DB_PATH)
+
+    # See _migration_compact_storage()
+    account_indexes = (
+        "block_store_from_key",
+        "block_store_to_key",
+        "block_store_miner_key",
+        "transaction_store_from_key",
+        "transaction_store_to_key",
+    )
+
+    cursor = db._reader().execute("EXPLAIN QUERY PLAN " + ACCOUNT_BALANCE_QUERY, {"account_id": "", "opening_balance": 0})
+    details = [row["detail"] for row in cursor.fetchall()]
+
+    # Steps reading a table, rather than the results of the subquery
+    reads = [d for d in details if d.split()[0] in ("SCAN", "SEARCH") and d.split()[1] in ("accounts", "account_keys", "block_store", "transaction_store")]
+
+    for detail in reads:
+        if not detail.startswith("SEARCH") or " USING COVERING INDEX " not in detail:
+            raise AssertionError(f"Not a search on a covering index: {detail}")
+
+    for index in account_indexes:
+        if not any(f" USING COVERING INDEX {index} " in detail for detail in reads):
+            raise AssertionError(f"Index {index} is not used. Query plan: {details}")
+
+
 if __name__ == '__main__':
-    db = BlockChain("db/PisitiCoin.sqlite3")
\ No newline at end of file
+    merkle_check()
+    print("Merkle roots commit to the amount of transactions: OK")
+
+    account_balance_plan_check()
+    print("Account balances are summed through covering indexes: OK")
\ No newline at end of file